@@ -0,0 +1,207 @@
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import importlib.util
+
+
+# Benchmark of v2v Helper on synthetic clips, no network or GPU needed
+# Clips are generated with ffmpeg lavfi sources, then run end to end through the extension handlers:
+# upload and extract, a local copy standing in for img2img, create video, and download frames
+#   python benchmark.py --output results.json
+#   python benchmark.py --output new.json --compare results.json
+# Needs ffmpeg and the A1111 python environment (gradio, numpy, PIL), A1111 itself doesn't need to run
+
+extension_dir = os.path.dirname(os.path.abspath(__file__))
+# Seconds below which a slower run is never flagged, timer noise on short stages
+min_regression_seconds = 0.05
+
+
+
+# Load the extension script outside A1111, with callbacks that register nothing and no test UI launched
+def load_extension(work_dir):
+    script_callbacks = types.SimpleNamespace(on_ui_tabs=lambda callback: None, on_app_started=lambda callback: None)
+    sys.modules["modules"] = types.SimpleNamespace(script_callbacks=script_callbacks)
+    spec = importlib.util.spec_from_file_location("v2v_helper", os.path.join(extension_dir, "scripts", "v2v-helper.py"))
+    extension = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(extension)
+
+    # keep benchmark jobs, cache, trash and metrics away from the real ones
+    extension.jobs_dir = os.path.join(work_dir, "jobs")
+    extension.frames_cache_dir = os.path.join(work_dir, "frames_cache")
+    extension.trash_dir = os.path.join(work_dir, "trash")
+    extension.metrics_log_path = os.path.join(work_dir, "metrics.jsonl")
+    return extension
+
+
+
+# First line of ffmpeg -version, results are only comparable on the same build
+def ffmpeg_version():
+    output = subprocess.check_output(["ffmpeg", "-version"], text=True)
+    return output.splitlines()[0]
+
+
+
+# Generate a synthetic clip with an ffmpeg lavfi source (testsrc, mandelbrot..)
+def generate_clip(clips_dir, source, size, seconds):
+    clip_path = os.path.join(clips_dir, f"{source}-{size}-{seconds}s.mp4")
+    if not os.path.exists(clip_path):
+        command = ["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", f"{source}=size={size}:rate=30",
+                   "-t", str(seconds), "-c:v", "libx264", "-pix_fmt", "yuv420p", clip_path]
+        subprocess.check_call(command, stdin=subprocess.DEVNULL)
+    return clip_path
+
+
+
+# Run a Gradio handler to its last output row, generator handlers stream progress rows before it
+def run_handler(handler, *args, **kwargs):
+    result = handler(*args, **kwargs)
+    if isinstance(result, types.GeneratorType):
+        for row in result:
+            result = row
+    if isinstance(result[0], str) and result[0].startswith("An exception occurred"):
+        raise Exception(result[0])
+    return result
+
+
+
+# Seconds of each extension stage of a job, from the metrics log
+def stage_seconds(extension, job_id):
+    stages = {}
+    with open(extension.metrics_log_path, 'r') as file:
+        for line in file:
+            record = json.loads(line)
+            if record["job_id"] == job_id:
+                stages[record["stage"]] = stages.get(record["stage"], 0) + record["seconds"]
+    return stages
+
+
+
+# Time one clip end to end, returning seconds by handler and by extension stage
+def run_clip(extension, clip_path, args):
+    handlers = {}
+
+    start_time = time.perf_counter()
+    row = run_handler(extension.extract_frames, clip_path, args.dedup, 2, 1, args.extract_workers, args.use_cache,
+                      args.frame_format)
+    handlers["extract_frames"] = time.perf_counter() - start_time
+    job_id = row[-1]
+    job = extension.get_job(job_id)
+
+    start_time = time.perf_counter()
+    extension.mock_img2img(job)
+    handlers["mock_img2img"] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    run_handler(extension.combine_frames, args.fps, job_id=job_id)
+    handlers["combine_frames"] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    run_handler(extension.download_zip_frames, job_id=job_id)
+    handlers["download_zip_frames"] = time.perf_counter() - start_time
+
+    frames = len(extension.read_frames_manifest(job)["frames"])
+    run_handler(extension.clear_frames, job_id)
+    return {"frames": frames, "handlers": handlers, "stages": stage_seconds(extension, job_id)}
+
+
+
+# Run every clip, keeping the fastest of the repeats of each timing
+def run_benchmark(args):
+    work_dir = tempfile.mkdtemp(prefix="v2v_benchmark_", dir=args.work_dir)
+    try:
+        extension = load_extension(work_dir)
+        clips_dir = os.path.join(work_dir, "clips")
+        os.makedirs(clips_dir)
+
+        results = []
+        for source in args.sources:
+            for size in args.sizes:
+                for seconds in args.lengths:
+                    clip_path = generate_clip(clips_dir, source, size, seconds)
+                    clip = os.path.splitext(os.path.basename(clip_path))[0]
+                    runs = [run_clip(extension, clip_path, args) for repeat in range(args.repeat)]
+                    result = {"clip": clip, "frames": runs[0]["frames"]}
+                    for group in ["handlers", "stages"]:
+                        names = set().union(*[run[group] for run in runs])
+                        result[group] = {name: round(min(run[group].get(name, float("inf")) for run in runs), 3)
+                                         for name in sorted(names)}
+                    total = sum(result["handlers"].values())
+                    print(f"{clip}: {result['frames']} frames in {total:.2f} s "
+                          + ", ".join(f"{name} {seconds:.2f} s" for name, seconds in result["handlers"].items()))
+                    results.append(result)
+
+        return {"time": time.time(), "ffmpeg": ffmpeg_version(), "python": platform.python_version(),
+                "cpu_count": os.cpu_count(), "frame_format": args.frame_format,
+                "extract_workers": args.extract_workers, "results": results}
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+
+# Timings slower than the baseline by more than tolerance, for clips and timings in both runs
+def find_regressions(baseline, current, tolerance):
+    regressions = []
+    baseline_clips = {result["clip"]: result for result in baseline["results"]}
+    for result in current["results"]:
+        baseline_result = baseline_clips.get(result["clip"])
+        if baseline_result is None:
+            continue
+        for group in ["handlers", "stages"]:
+            for name, seconds in result[group].items():
+                baseline_seconds = baseline_result[group].get(name)
+                if baseline_seconds is None:
+                    continue
+                if seconds > baseline_seconds * (1 + tolerance) and seconds - baseline_seconds > min_regression_seconds:
+                    slowdown = f"+{(seconds / baseline_seconds - 1) * 100:.0f}%" if baseline_seconds > 0 else "new cost"
+                    regressions.append(f"{result['clip']} {name}: {baseline_seconds:.3f} s -> {seconds:.3f} s ({slowdown})")
+    return regressions
+
+
+
+# Run the benchmark, save its results and compare them to a baseline
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark v2v Helper on synthetic ffmpeg clips.")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file for the results")
+    parser.add_argument("--compare", help="baseline results JSON, exit with 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="slowdown allowed before flagging, 0.15 is 15%%")
+    parser.add_argument("--sources", nargs="+", default=["testsrc", "mandelbrot"], help="lavfi video sources")
+    parser.add_argument("--sizes", nargs="+", default=["640x360", "1280x720", "1920x1080"], help="clip resolutions")
+    parser.add_argument("--lengths", nargs="+", type=int, default=[5, 20], help="clip lengths in seconds")
+    parser.add_argument("--repeat", type=int, default=1, help="runs of each clip, the fastest is kept")
+    parser.add_argument("--fps", type=int, default=30, help="frames per second of created videos")
+    parser.add_argument("--frame-format", default="PNG", choices=["PNG", "JPEG", "WebP", "WebP lossless"])
+    parser.add_argument("--extract-workers", type=int, default=1, help="ffmpeg processes extracting each clip")
+    parser.add_argument("--dedup", action="store_true", help="skip near-duplicate frames")
+    parser.add_argument("--use-cache", action="store_true", help="reuse extracted frames between repeats")
+    parser.add_argument("--work-dir", help="folder for clips and jobs (default: system temp folder)")
+    parser.add_argument("--keep", action="store_true", help="keep clips and jobs after the run")
+    args = parser.parse_args()
+
+    current = run_benchmark(args)
+    with open(args.output, 'w') as file:
+        json.dump(current, file, indent=2)
+    print(f"Results saved to {args.output}..")
+
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            baseline = json.load(file)
+        if baseline["ffmpeg"] != current["ffmpeg"]:
+            print(f"ffmpeg build changed: {baseline['ffmpeg']} -> {current['ffmpeg']}")
+        regressions = find_regressions(baseline, current, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        print(f"{len(regressions)} regressions against {args.compare}..")
+        sys.exit(1 if regressions else 0)
+
+
+
+if __name__ == "__main__":
+    main()
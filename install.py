@@ -1,9 +1,8 @@
 import os
-import inspect
 import subprocess
 import sys
 import configparser
-from packaging import version
+import importlib.util
 
 # current A1111 gradio version. 
 # Update here for future changes in Automatic1111 (see requirements-versions.txt):
@@ -11,24 +10,26 @@ gradio_version = "3.41.2"
 
 # Set test_environment to False in a real Automatic1111 environment
 # If true, it will create interface elements for testing purposes, and will mock img2img processing just downloading a pre-prepared set of frames.
+# A1111 runs this script on every launch, so script_callbacks is only looked up, importing it loads gradio and fastapi
 test_environment = False
 try:
-    from modules import script_callbacks
+    if importlib.util.find_spec("modules.script_callbacks") is None:
+        raise ImportError("modules.script_callbacks not found")
 except Exception as error:
-    print(f"An error occurred importing A1111 script_callbacks: {error}")
+    print(f"An error occurred finding A1111 script_callbacks: {error}")
     print("Setting environment to test mode..")
     test_environment = True
 
 # Path to A1111 extension directory in test mode
 base_dir = "/content/stable-diffusion-webui/extensions/sd-webui-v2v-helper/"
 if not test_environment:
-    # Get the current script path and its parents
-    script_path = os.path.abspath(inspect.getfile(inspect.currentframe()))
-    parent_path = os.path.dirname(script_path) # use this on install.py
-    base_dir = parent_path
+    # extension folder, where this script is
+    base_dir = os.path.dirname(os.path.abspath(__file__))
 
 
 def install_gradio(target_version=gradio_version):
+    # only needed in test mode, A1111 brings its own gradio
+    from packaging import version
     try:
         import gradio as gr
         if version.parse(gr.__version__) == version.parse(target_version):
@@ -45,10 +46,12 @@ def install_gradio(target_version=gradio_version):
         print(f"Gradio {target_version} has been installed.")
 
 
+# Colab sets COLAB_RELEASE_TAG, google.colab is only looked up since importing it loads IPython
 def is_google_colab():
-    try:
-        import google.colab
+    if "COLAB_RELEASE_TAG" in os.environ:
         return True
+    try:
+        return importlib.util.find_spec("google.colab") is not None
     except ImportError:
         return False
 
@@ -3,7 +3,21 @@ import subprocess
 import gradio as gr
 import shutil
 import zipfile
-import inspect
+import json
+import hashlib
+import re
+import math
+import threading
+import uuid
+import time
+import tempfile
+import shlex
+import signal
+from contextlib import contextmanager
+from fractions import Fraction
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import numpy as np
+from PIL import Image
 
 
 # Set test_environment to False in a real Automatic1111 environment
@@ -19,54 +33,287 @@ except Exception as error:
 # Path to A1111 extension directory in test mode
 base_dir = "/content/stable-diffusion-webui/extensions/sd-webui-v2v-helper/"
 if not test_environment:
-    # Get the current script path and its parents
-    script_path = os.path.abspath(inspect.getfile(inspect.currentframe()))
-    parent_path = os.path.dirname(script_path)
-    grandparent_path = os.path.dirname(parent_path) # use this on v2v-helper.py
-    base_dir = grandparent_path
+    # extension folder, parent of this script's scripts/ folder
+    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
 # Define folders
-frames_dir = os.path.join(base_dir,"video_frames")
-frames_generated_dir = os.path.join(base_dir,"video_frames_generated")
-input_video_dir = os.path.join(base_dir,"input_video")
-output_video_dir = os.path.join(base_dir,"output_video")
+# each uploaded video gets its own workspace in jobs folder
+jobs_dir = os.path.join(base_dir,"jobs")
+# extracted frames reused when the same video is extracted again with the same parameters
+frames_cache_dir = os.path.join(base_dir,"frames_cache")
+# Size cap of the frames cache, least recently used videos are evicted first
+frames_cache_max_bytes = 20 * 1024 ** 3
+# Disk quota of jobs and frames cache together, the housekeeper evicts least recently used artefacts above it (0 disables)
+disk_quota_bytes = 50 * 1024 ** 3
+# Free space the housekeeper keeps on the disk of jobs folder, so extraction doesn't fail halfway
+min_free_bytes = 5 * 1024 ** 3
+# Jobs used within this many seconds are never evicted
+eviction_grace_seconds = 60 * 60
+# Seconds between housekeeper disk scans
+housekeeping_interval = 60
+# removed files are moved here, then deleted by the housekeeper, so no request waits for a large delete
+trash_dir = os.path.join(base_dir,"trash")
+# Disk usage by artefact kind at the last housekeeper scan, for the metrics endpoint
+disk_usage_totals = {}
+housekeeper = {"thread": None, "wake": threading.Event(), "last_scan": 0}
+housekeeper_lock = threading.Lock()
+# Highest frame rate frames are extracted at, faster videos keep every 2nd (3rd..) frame, see extract_rate
+# Generated frames are laid out at the extraction rate, so the video keeps the source timing
+max_extract_fps = 30
+# Shortest shot split at a scene cut, closer cuts are dropped so flashes and fast cutting don't make tiny shots
+min_shot_seconds = 1
+# Minimum frames per segment when extracting or encoding in parallel, shorter clips use a single ffmpeg process
+min_segment_frames = 300
+# Height of preview videos, smaller frames are not upscaled
+preview_height = 360
+# Audio codecs muxed into the output mp4 as they are, others are encoded to AAC
+mp4_audio_codecs = ["aac", "mp3", "ac3", "eac3", "alac"]
+# libx264 options of Create Video encoder profiles, the target bitrate profile runs two passes instead, see encoder_passes
+encoder_profiles = {"Draft (fastest)": ["-preset", "ultrafast", "-crf", "28"],
+                    "Balanced": ["-preset", "medium", "-crf", "23"],
+                    "Archival (best quality)": ["-preset", "slow", "-crf", "17"],
+                    "Target bitrate (two-pass)": ["-preset", "medium"]}
+two_pass_profile = "Target bitrate (two-pass)"
+# Seconds of frames sample-encoded by estimate_video, in equal parts from the start, middle and end of the video
+estimate_sample_seconds = 3
+# Seconds between scans of img2img output in watch mode
+watch_interval = 2
+# Seconds of video and (format, PNG level, quality) settings compared by compare_frame_formats
+format_benchmark_seconds = 10
+format_benchmark_settings = [("PNG", 6, 90), ("PNG", 1, 90), ("JPEG", 6, 95), ("WebP", 6, 90), ("WebP lossless", 6, 90)]
+# ffmpeg encoder writing each intermediate frame format
+frame_format_encoders = {"PNG": "png", "JPEG": "mjpeg", "WebP": "libwebp", "WebP lossless": "libwebp"}
+# ffmpeg version, encoders and filters, probed once and cached on disk until the ffmpeg binary changes
+ffmpeg_capabilities_path = os.path.join(base_dir, "ffmpeg_capabilities.json")
+ffmpeg_capabilities_cache = {}
+ffmpeg_capabilities_lock = threading.Lock()
+# Cap of concurrent ffmpeg processes (and frame archives) on this machine, further work waits in queue
+max_ffmpeg_processes = os.cpu_count() or 1
+ffmpeg_slots = threading.BoundedSemaphore(max_ffmpeg_processes)
+# Slots held right now by the work of all jobs, encoders share the cores between them, see encoder_threads
+ffmpeg_slots_in_use = {"count": 0}
+ffmpeg_slots_lock = threading.Lock()
+# Seconds between progress updates of extraction and video creation
+progress_interval = 1
+# Wall time, frames, bytes and ffmpeg speed of each stage of each job, one JSON object per line
+metrics_log_path = os.path.join(base_dir, "metrics.jsonl")
+# Serve stage totals in Prometheus text format at /v2v-helper/metrics
+metrics_endpoint = False
+# Totals by stage since start, for the metrics endpoint
+stage_totals = {}
+metrics_lock = threading.Lock()
+# Folders the batch API may read videos from by path (video_path form field), uploads are always accepted
+# Empty by default, so API clients can't have any file of this machine copied into a job and read it back
+api_video_dirs = []
+# Jobs by id, see get_job
+jobs = {}
+jobs_lock = threading.Lock()
 # external CSS file
 css_dir = os.path.join(base_dir, "style.css")
 
 
 
+# Work directories and state of one uploaded video
+class Job:
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.job_dir = os.path.join(jobs_dir, job_id)
+        self.frames_dir = os.path.join(self.job_dir,"video_frames")
+        self.frames_generated_dir = os.path.join(self.job_dir,"video_frames_generated")
+        self.input_video_dir = os.path.join(self.job_dir,"input_video")
+        self.output_video_dir = os.path.join(self.job_dir,"output_video")
+        # near-duplicate frames moved out of img2img input
+        self.frames_duplicates_dir = os.path.join(self.job_dir,"video_frames_duplicates")
+        # frames not generated yet, to resume an interrupted img2img batch
+        self.frames_missing_dir = os.path.join(self.job_dir,"video_frames_missing")
+        # frames of each shot split at scene cuts, one img2img batch folder per shot, see write_shot_batches
+        self.shots_dir = os.path.join(self.job_dir,"video_frames_shots")
+        # manifest describing how extracted frames map to the original timeline
+        self.frames_manifest_path = os.path.join(self.input_video_dir,"frames.json")
+        # ffprobe result of the saved video, see probe_input_video
+        self.video_probe_path = os.path.join(self.input_video_dir,"video.json")
+        # audio track of the input video, stream copied as is, Matroska takes any codec
+        self.audio_path = os.path.join(self.input_video_dir,"audio.mka")
+        # background encoder following img2img output, see watch_generated_frames
+        self.watch = {"thread": None, "finish": threading.Event(), "stop": threading.Event(),
+                      "output": None, "error": None, "settings": None, "missing": []}
+        # running extraction or video creation, its ffmpeg processes and progress, see stream_progress
+        self.task = None
+        self.processes = set()
+        self.cancelled = threading.Event()
+        self.progress = {"stage": None, "total": 0, "done": 0, "frames": 0, "processes": {}, "start": 0}
+        # final report of each finished ffmpeg process, see measure_stage
+        self.ffmpeg_runs = []
+
+
+
+# Create a job for a new upload, with its own work directories
+def create_job():
+    job = Job(uuid.uuid4().hex[:12])
+    create_directories(job)
+    with jobs_lock:
+        jobs[job.job_id] = job
+    print(f"Job {job.job_id} created..")
+    return job
+
+
+
+# Job of an id kept in the UI session, also for jobs created before a restart
+def get_job(job_id):
+    if not job_id:
+        raise Exception("No video uploaded yet.")
+    # ids are only hex, so they can't point outside jobs folder
+    if not re.fullmatch(r"[0-9a-f]{12}", job_id) or not os.path.isdir(os.path.join(jobs_dir, job_id)):
+        raise Exception(f"Job {job_id} not found, upload your video again.")
+    # the job folder modification time tracks its last use, for LRU eviction
+    os.utime(os.path.join(jobs_dir, job_id))
+    with jobs_lock:
+        if job_id not in jobs:
+            jobs[job_id] = Job(job_id)
+        return jobs[job_id]
+
+
+
 # Ensure the work directories exists
-def create_directories():
-    os.makedirs(frames_dir, exist_ok=True)
-    os.makedirs(frames_generated_dir, exist_ok=True)
-    os.makedirs(input_video_dir, exist_ok=True)
-    os.makedirs(output_video_dir, exist_ok=True)
+def create_directories(job):
+    os.makedirs(job.frames_dir, exist_ok=True)
+    os.makedirs(job.frames_generated_dir, exist_ok=True)
+    os.makedirs(job.input_video_dir, exist_ok=True)
+    os.makedirs(job.output_video_dir, exist_ok=True)
+    os.makedirs(job.frames_duplicates_dir, exist_ok=True)
+    os.makedirs(job.frames_missing_dir, exist_ok=True)
+    os.makedirs(frames_cache_dir, exist_ok=True)
+
 
 
+# Remove work directories of a job
+def remove_directories(job):
+    trash_path(job.job_dir)
+    with jobs_lock:
+        jobs.pop(job.job_id, None)
 
-# Remove work directories
-def remove_directories():
-    shutil.rmtree(frames_dir)
-    shutil.rmtree(frames_generated_dir)
-    shutil.rmtree(input_video_dir)
-    shutil.rmtree(output_video_dir)
 
 
+# Remove a job, after killing its ffmpeg processes and stopping its watch mode
+def remove_job(job):
+    cancel_job(job.job_id)
+    stop_watch(job)
+    remove_directories(job)
+    print(f"Job {job.job_id} removed..")
 
-# Save the uploaded video to input directory
-def save_video(videofile):
+
+
+# Hold one of the machine ffmpeg slots while running heavy work, waiting in queue if all are busy
+@contextmanager
+def ffmpeg_slot(name):
+    if not ffmpeg_slots.acquire(blocking=False):
+        print(f"All {max_ffmpeg_processes} ffmpeg slots busy, {name} waiting in queue..")
+        ffmpeg_slots.acquire()
+    with ffmpeg_slots_lock:
+        ffmpeg_slots_in_use["count"] += 1
+    try:
+        yield
+    finally:
+        with ffmpeg_slots_lock:
+            ffmpeg_slots_in_use["count"] -= 1
+        ffmpeg_slots.release()
+
+
+
+# Append a stage record to the metrics log, and add it to the totals of its stage
+def write_metrics(record):
+    with metrics_lock:
+        with open(metrics_log_path, 'a') as file:
+            file.write(json.dumps(record) + "\n")
+        totals = stage_totals.setdefault(record["stage"], {"runs": {}, "seconds": 0, "frames": 0,
+                                                           "bytes_read": 0, "bytes_written": 0, "ffmpeg_speed": None})
+        totals["runs"][record["status"]] = totals["runs"].get(record["status"], 0) + 1
+        totals["seconds"] += record["seconds"]
+        for key in ["frames", "bytes_read", "bytes_written"]:
+            totals[key] += record[key] or 0
+        if record.get("ffmpeg_speed") is not None:
+            totals["ffmpeg_speed"] = record["ffmpeg_speed"]
+
+
+
+# Time a stage of a job, writing its wall time, frames, bytes read and written, and ffmpeg speed to the metrics log
+# The stage fills frames, bytes_read and bytes_written of the yielded record, and may add its own fields
+@contextmanager
+def measure_stage(job, stage):
+    record = {"time": time.time(), "job_id": job.job_id, "stage": stage, "status": "ok",
+              "seconds": None, "frames": None, "bytes_read": None, "bytes_written": None}
+    first_run = len(job.ffmpeg_runs)
+    start_time = time.perf_counter()
+    try:
+        yield record
+    except Exception:
+        record["status"] = "cancelled" if job.cancelled.is_set() else "failed"
+        raise
+    finally:
+        record["seconds"] = round(time.perf_counter() - start_time, 3)
+        runs = job.ffmpeg_runs[first_run:]
+        speeds = [run["speed"] for run in runs if "speed" in run]
+        if runs:
+            record["ffmpeg_processes"] = len(runs)
+        if speeds:
+            # mean speed of one process, times realtime
+            record["ffmpeg_speed"] = round(sum(speeds) / len(speeds), 3)
+        try:
+            write_metrics(record)
+        except Exception as error:
+            print(f"Metrics not written: {error}")
+
+
+
+# Prometheus text format of the stage totals
+def metrics_text():
+    lines = []
+    with metrics_lock:
+        totals = dict(stage_totals)
+        metrics = [("runs_total", "counter", "Stage runs by status"),
+                   ("seconds_total", "counter", "Wall time spent in the stage"),
+                   ("frames_total", "counter", "Frames processed by the stage"),
+                   ("bytes_read_total", "counter", "Bytes read by the stage"),
+                   ("bytes_written_total", "counter", "Bytes written by the stage"),
+                   ("ffmpeg_speed", "gauge", "ffmpeg speed of the last stage run, times realtime")]
+        for name, kind, description in metrics:
+            lines.append(f"# HELP v2v_helper_stage_{name} {description}")
+            lines.append(f"# TYPE v2v_helper_stage_{name} {kind}")
+            for stage, stage_total in sorted(totals.items()):
+                if name == "runs_total":
+                    for status, count in sorted(stage_total["runs"].items()):
+                        lines.append(f'v2v_helper_stage_{name}{{stage="{stage}",status="{status}"}} {count}')
+                    continue
+                value = stage_total[name.replace("_total", "")]
+                if value is not None:
+                    lines.append(f'v2v_helper_stage_{name}{{stage="{stage}"}} {value}')
+
+    lines.append("# HELP v2v_helper_disk_bytes Disk usage by artefact kind at the last housekeeper scan")
+    lines.append("# TYPE v2v_helper_disk_bytes gauge")
+    for kind, usage in sorted(dict(disk_usage_totals).items()):
+        lines.append(f'v2v_helper_disk_bytes{{kind="{kind}"}} {usage}')
+    return "\n".join(lines) + "\n"
+
+
+
+# Save the uploaded video, or a video path given to the batch API, to input directory
+# The video is hardlinked when it's on the same disk, only copied otherwise, and any container ffprobe reads is taken
+def save_video(job, videofile):
     try:
         if videofile is not None:
-            # Check if the file is an mp4
-            if videofile.name.endswith('.mp4'):
-                print(f"Saving video: {videofile.name}")
-                video_path = os.path.join(input_video_dir,"input.mp4" )
-                shutil.copyfile(videofile.name, video_path)
-                print(f"Video saved to {video_path}..")
-                return video_path
-            else:
-                raise Exception("The uploaded file is not an mp4.")
+            source_path = videofile if isinstance(videofile, str) else videofile.name
+            print(f"Saving video: {source_path}")
+            # the container extension is kept, a few demuxers rely on it
+            video_path = os.path.join(job.input_video_dir, "input" + os.path.splitext(source_path)[1].lower())
+            linked = link_or_copy(source_path, video_path)
+            print(f"Video {'linked' if linked else 'copied'} to {video_path}..")
+            try:
+                probe_input_video(job, video_path)
+            except Exception:
+                os.remove(video_path)
+                raise
+            return video_path
         else:
             raise Exception("No video file uploaded.")
     except Exception as error:
@@ -75,145 +322,1964 @@ def save_video(videofile):
 
 
 
-# Rename frame files to a simpler format, to use in ffmpeg
-def rename_files(directory):
-    # Get a list of all files in the directory
-    files = os.listdir(directory)
+# Path of the saved video of a job, None before a video is saved
+def input_video_path(job):
+    if not os.path.exists(job.video_probe_path):
+        return None
+    with open(job.video_probe_path, 'r') as file:
+        return os.path.join(job.input_video_dir, json.load(file)["filename"])
 
-    # Iterate through each file
-    for filename in files:
-        # Split the filename into parts using "-"
-        parts = filename.split("-")
 
-        # Check if the filename has the pattern we're looking for
-        if len(parts) == 2 and parts[1].startswith("frame"):
-            # Extract the part before the "-"
-            prefix = parts[0]
-            # Extract the part after the "-"
-            suffix = parts[1].split(".")[1]  # Extracting the file extension
 
-            # Form the new filename
-            new_filename = f"{prefix}.{suffix}"
+# Hardlink a file to a new path, copying it if linking is not possible
+# Returns True when the file was linked
+def link_or_copy(source_path, target_path):
+    if os.path.exists(target_path):
+        os.remove(target_path)
+    try:
+        os.link(source_path, target_path)
+        return True
+    except OSError:
+        shutil.copyfile(source_path, target_path)
+        return False
 
-            # Construct the full path for both old and new filenames
-            old_filepath = os.path.join(directory, filename)
-            new_filepath = os.path.join(directory, new_filename)
 
-            # Rename the file
-            os.rename(old_filepath, new_filepath)
-            #print(f"Renamed '{filename}' to '{new_filename}'")
 
+# Read the frames manifest written on extraction
+# Frames extracted before manifests existed map one to one to the files in frames directory
+def read_frames_manifest(job):
+    if not os.path.exists(job.frames_manifest_path):
+        return {"frames": sorted(os.listdir(job.frames_dir), key=frame_number), "duplicates": {}}
+    with open(job.frames_manifest_path, 'r') as file:
+        manifest = json.load(file)
+    # manifests written before frames were ordered by number, also restored from the frames cache
+    manifest["frames"].sort(key=frame_number)
+    return manifest
 
 
-# Mock img2img batch: download frames.zip and unzip for testing purposes
-def download_and_unzip_frames(url, target_directory):
-    try:
-        # Download frames.zip using wget
-        wget_command = f"wget -c {url} -P {target_directory}"
-        subprocess.call(wget_command, shell=True)
 
-        target_file = os.path.join(target_directory, "frames.zip");
+# Write the frames manifest used by combine_frames to rebuild the original timeline
+def write_frames_manifest(job, manifest):
+    with open(job.frames_manifest_path, 'w') as file:
+        json.dump(manifest, file, indent=2)
 
-        # Unzip frames.zip
-        unzip_command = f"unzip {target_file} -d {target_directory}"
-        subprocess.call(unzip_command, shell=True)
 
-        # Remove frames.zip
-        rm_command = f"rm {target_file}"
-        subprocess.call(rm_command, shell=True)
 
-        print("img2img mocked: frames downloaded, extracted, and zip file removed successfully..")
-        return True
+# Small grayscale copy of a frame, cheap to compare against other frames
+def frame_thumbnail(file_path, size=(32, 32)):
+    with Image.open(file_path) as image:
+        return np.asarray(image.convert("L").resize(size, Image.BILINEAR), dtype=np.float32)
+
+
+
+# Number of an extracted frame file, frames are ordered by it and not by name:
+# past frame9999 ffmpeg writes a fifth digit, and "frame10000.png" sorts before "frame1001.png" as a string
+def frame_number(filename):
+    return int(re.search(r"\d+", filename).group())
+
+
+
+# Move near-duplicate frames out of img2img input directory
+# Each frame is compared to the last kept frame, so slow drifts still produce new frames
+def remove_duplicate_frames(directory, duplicates_directory, threshold):
+    for filename in os.listdir(duplicates_directory):
+        os.remove(os.path.join(duplicates_directory, filename))
+
+    duplicates = {}
+    kept_frame = None
+    kept_thumbnail = None
+    for filename in sorted(os.listdir(directory), key=frame_number):
+        thumbnail = frame_thumbnail(os.path.join(directory, filename))
+        if kept_thumbnail is not None and np.abs(thumbnail - kept_thumbnail).mean() <= threshold:
+            shutil.move(os.path.join(directory, filename),
+                        os.path.join(duplicates_directory, filename))
+            duplicates[filename] = kept_frame
+        else:
+            kept_frame = filename
+            kept_thumbnail = thumbnail
+
+    return duplicates
+
+
+
+# Map source frame names to generated frame files, e.g. "frame0007" -> "00003-frame0007.png"
+def find_generated_frames(directory):
+    generated = {}
+    for filename in os.listdir(directory):
+        match = re.search(r"(frame\d+)", filename)
+        if match:
+            generated[match.group(1)] = filename
+    return generated
+
+
+
+# Generated file for each position of the original timeline, None where it's not generated yet
+def timeline_frames(manifest, generated):
+    duplicates = manifest.get("duplicates", {})
+    return [generated.get(os.path.splitext(duplicates.get(frame, frame))[0])
+            for frame in manifest["frames"]]
+
 
-    except Exception as e:
-        print(f"An error occurred: {e}")
+
+# Generated file for each position of the original timeline, whatever img2img naming was used
+# A1111 keeps the source name in its output ("00003-frame0007.png" or "frame0007.png"); older
+# generated sets renamed to "00003.png" are matched by their A1111 counter to the frames sent to img2img
+def generated_timeline(directory, manifest):
+    return timeline_frames(manifest, match_generated_frames(directory, manifest))
+
+
+
+# Map source frame names to generated frame files, also for generated sets renamed by older versions
+def match_generated_frames(directory, manifest):
+    generated = find_generated_frames(directory)
+    if not generated:
+        duplicates = manifest.get("duplicates", {})
+        sent_frames = [os.path.splitext(frame)[0] for frame in manifest["frames"] if frame not in duplicates]
+        counters = {int(os.path.splitext(filename)[0]): filename
+                    for filename in os.listdir(directory) if os.path.splitext(filename)[0].isdigit()}
+        first_counter = min(counters, default=0)
+        generated = {frame: counters[first_counter + index]
+                     for index, frame in enumerate(sent_frames) if first_counter + index in counters}
+    return generated
+
+
+
+# Check an image file was completely written, from its size and end of file marker
+def is_complete_image(file_path):
+    size = os.path.getsize(file_path)
+    if size == 0:
         return False
+    with open(file_path, 'rb') as file:
+        header = file.read(12)
+        file.seek(max(0, size - 12))
+        trailer = file.read()
+    if header.startswith(b"\x89PNG"):
+        return b"IEND" in trailer
+    if header.startswith(b"\xff\xd8"):
+        return trailer.endswith(b"\xff\xd9")
+    if header.startswith(b"RIFF") and header[8:12] == b"WEBP":
+        return int.from_bytes(header[4:8], "little") + 8 <= size
+    return True
 
 
 
-# Extract frames from video
-def extract_frames(videofile):
-    try:
-        create_directories();
+# Build an img2img input directory with only the frames not generated yet
+# Truncated or empty generated frames are removed, so they are generated again
+def build_missing_frames(job):
+    manifest = read_frames_manifest(job)
+    generated = match_generated_frames(job.frames_generated_dir, manifest)
+
+    corrupt = 0
+    for frame, filename in list(generated.items()):
+        file_path = os.path.join(job.frames_generated_dir, filename)
+        if not is_complete_image(file_path):
+            print(f"Removing incomplete generated frame {filename}..")
+            os.remove(file_path)
+            del generated[frame]
+            corrupt += 1
+
+    trash_path(job.frames_missing_dir)
+    os.makedirs(job.frames_missing_dir)
+    missing = [filename for filename in sorted(os.listdir(job.frames_dir), key=frame_number)
+               if os.path.splitext(filename)[0] not in generated]
+    for filename in missing:
+        link_or_copy(os.path.join(job.frames_dir, filename), os.path.join(job.frames_missing_dir, filename))
+
+    return missing, corrupt
+
+
+
+# Fill timeline positions without a generated frame by repeating the previous one
+# (the first generated one at the start), returns the filled timeline and the missing frames
+def fill_missing_frames(manifest, frame_files):
+    missing = [frame for frame, filename in zip(manifest["frames"], frame_files) if filename is None]
+    previous = next((filename for filename in frame_files if filename is not None), None)
+    if previous is None:
+        raise Exception("No generated frames found.")
+
+    filled = []
+    for filename in frame_files:
+        previous = filename if filename is not None else previous
+        filled.append(previous)
+    return filled, missing
 
-        # Saves video in directory
-        video_path = save_video(videofile)
 
-        file_path_pattern = os.path.join(frames_dir,"frame%4d.png")
 
-        print('Extracting frames..')
+# Mock img2img batch for testing purposes and benchmarks: copy extracted frames to the generated
+# frames directory, as img2img batch names its output, keeping frames already generated
+def mock_img2img(job):
+    generated = find_generated_frames(job.frames_generated_dir)
+    copied = 0
+    for filename in sorted(os.listdir(job.frames_dir), key=frame_number):
+        if os.path.splitext(filename)[0] not in generated:
+            shutil.copyfile(os.path.join(job.frames_dir, filename), os.path.join(job.frames_generated_dir, filename))
+            copied += 1
+    print(f"img2img mocked: {copied} frames copied..")
+    return copied
 
-        command = f"ffmpeg -i {video_path} -r 25 -start_number 0001 {file_path_pattern}"
-        print(command)
 
-        return_code = subprocess.call(command, shell=True)
+
+# sha256 of a file, read in chunks so large videos don't have to fit in memory
+def hash_file(file_path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+
+# Cache key of the frames extracted from a video with the given extraction parameters
+def frames_cache_key(video_path, parameters):
+    key = json.dumps({"video": hash_file(video_path), "parameters": parameters}, sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+
+# Hardlink every file of a directory into another one
+def link_directory(source_directory, target_directory):
+    os.makedirs(target_directory, exist_ok=True)
+    for filename in os.listdir(source_directory):
+        link_or_copy(os.path.join(source_directory, filename), os.path.join(target_directory, filename))
+
+
+
+# Restore frames, duplicates and manifest from the cache, returns False if they aren't cached
+def restore_cached_frames(job, cache_key):
+    entry_dir = os.path.join(frames_cache_dir, cache_key)
+    if not os.path.isdir(entry_dir):
+        return False
+
+    print(f"Restoring frames from cache {cache_key[:12]}..")
+    # the entry modification time tracks its last use, for LRU eviction, touched first so it's not evicted while restored
+    os.utime(entry_dir)
+    link_directory(os.path.join(entry_dir, "video_frames"), job.frames_dir)
+    link_directory(os.path.join(entry_dir, "video_frames_duplicates"), job.frames_duplicates_dir)
+    shutil.copyfile(os.path.join(entry_dir, "frames.json"), job.frames_manifest_path)
+    return True
+
+
+
+# Store extracted frames, duplicates and manifest in the cache, then evict old entries over the size cap
+def store_cached_frames(job, cache_key):
+    entry_dir = os.path.join(frames_cache_dir, cache_key)
+    # build the entry aside, so an interrupted store never leaves a partial entry
+    temp_dir = f"{entry_dir}.tmp"
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    link_directory(job.frames_dir, os.path.join(temp_dir, "video_frames"))
+    link_directory(job.frames_duplicates_dir, os.path.join(temp_dir, "video_frames_duplicates"))
+    shutil.copyfile(job.frames_manifest_path, os.path.join(temp_dir, "frames.json"))
+    trash_path(entry_dir)
+    os.rename(temp_dir, entry_dir)
+    print(f"Frames stored in cache {cache_key[:12]}..")
+    evict_frames_cache(keep=cache_key)
+
+
+
+# Total size of the files in a directory tree
+def directory_size(directory):
+    size = 0
+    for root, dirs, files in os.walk(directory):
+        for file in files:
+            size += os.path.getsize(os.path.join(root, file))
+    return size
+
+
+
+# Remove least recently used cache entries until the cache fits in frames_cache_max_bytes
+def evict_frames_cache(keep=None):
+    entries = []
+    for name in os.listdir(frames_cache_dir):
+        entry_dir = os.path.join(frames_cache_dir, name)
+        entries.append((os.path.getmtime(entry_dir), directory_size(entry_dir), name, entry_dir))
+
+    total_size = sum(entry[1] for entry in entries)
+    for mtime, size, name, entry_dir in sorted(entries):
+        if total_size <= frames_cache_max_bytes:
+            break
+        if name == keep:
+            continue
+        print(f"Evicting frames cache {name[:12]}..")
+        trash_path(entry_dir)
+        total_size -= size
+
+
+
+# Disk space used by the files of a directory tree, or a file
+# Files hardlinked n times count 1/n in each place, so jobs sharing frames with the cache aren't counted twice
+def disk_usage(path):
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return stat.st_size / stat.st_nlink
+    usage = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            try:
+                stat = os.stat(os.path.join(root, file))
+            except OSError:
+                # removed while walking
+                continue
+            usage += stat.st_size / stat.st_nlink
+    return usage
+
+
+
+# Move a file or directory to the trash folder, it's gone right away and deleted by the housekeeper in the background
+def trash_path(path):
+    if not os.path.lexists(path):
+        return
+    os.makedirs(trash_dir, exist_ok=True)
+    try:
+        os.rename(path, os.path.join(trash_dir, f"{uuid.uuid4().hex[:12]}-{os.path.basename(path)}"))
+    except OSError:
+        # trash folder on another disk, removed right away
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+        return
+    start_housekeeper()
+    housekeeper["wake"].set()
+
+
+
+# Delete everything in the trash folder
+def empty_trash():
+    if not os.path.isdir(trash_dir):
+        return
+    for name in os.listdir(trash_dir):
+        path = os.path.join(trash_dir, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+
+
+
+# Artefacts the housekeeper may evict, as (last use, rank, bytes, name, paths)
+# Within a job, the frames archive goes first (rank 0), then created videos (1), then the whole job (2)
+# Jobs extracting, creating a video or in watch mode are left alone
+def disk_artefacts():
+    artefacts = []
+    kinds = {}
+    for name in os.listdir(frames_cache_dir) if os.path.isdir(frames_cache_dir) else []:
+        entry_dir = os.path.join(frames_cache_dir, name)
+        usage = disk_usage(entry_dir)
+        kinds["frames_cache"] = kinds.get("frames_cache", 0) + usage
+        if not name.endswith(".tmp"):
+            artefacts.append((os.path.getmtime(entry_dir), 0, usage, f"frames cache {name[:12]}", [entry_dir]))
+
+    for job_id in os.listdir(jobs_dir) if os.path.isdir(jobs_dir) else []:
+        if not re.fullmatch(r"[0-9a-f]{12}", job_id):
+            continue
+        job = Job(job_id)
+        with jobs_lock:
+            job = jobs.get(job_id, job)
+        busy = ((job.task is not None and not job.task.done())
+                or (job.watch["thread"] is not None and job.watch["thread"].is_alive()))
+
+        usages = {}
+        for kind, directory in [("frames", job.frames_dir), ("frames", job.frames_duplicates_dir),
+                                ("frames", job.frames_missing_dir), ("frames", job.shots_dir),
+                                ("frames_generated", job.frames_generated_dir),
+                                ("input_video", job.input_video_dir), ("output_video", job.output_video_dir)]:
+            usages[kind] = usages.get(kind, 0) + disk_usage(directory)
+        zip_paths = [os.path.join(job.output_video_dir, name) for name in ["frames.zip", "frames.zip.fingerprint"]]
+        usages["frames_zip"] = sum(disk_usage(path) for path in zip_paths if os.path.exists(path))
+        usages["output_video"] -= usages["frames_zip"]
+        for kind, usage in usages.items():
+            kinds[kind] = kinds.get(kind, 0) + usage
+        if busy:
+            continue
+
+        # img2img writing generated frames is a use of the job too
+        last_used = max(os.path.getmtime(path) for path in [job.job_dir, job.frames_generated_dir] if os.path.exists(path))
+        output_paths = [os.path.join(job.output_video_dir, name) for name in os.listdir(job.output_video_dir)
+                        if not name.startswith("frames.zip")] if os.path.isdir(job.output_video_dir) else []
+        artefacts.append((last_used, 0, usages["frames_zip"], f"job {job_id} frames archive", zip_paths))
+        artefacts.append((last_used, 1, usages["output_video"], f"job {job_id} videos", output_paths))
+        artefacts.append((last_used, 2, sum(usages.values()) - usages["frames_zip"] - usages["output_video"],
+                          f"job {job_id}", [job.job_dir]))
+
+    kinds["trash"] = disk_usage(trash_dir) if os.path.isdir(trash_dir) else 0
+    disk_usage_totals.clear()
+    disk_usage_totals.update({kind: round(usage) for kind, usage in kinds.items()})
+    return artefacts
+
+
+
+# Evict least recently used artefacts until jobs and cache fit in disk_quota_bytes, and the disk keeps min_free_bytes
+def enforce_disk_quota():
+    artefacts = disk_artefacts()
+    usage = sum(usage for kind, usage in disk_usage_totals.items() if kind != "trash")
+    os.makedirs(jobs_dir, exist_ok=True)
+    over = min_free_bytes - shutil.disk_usage(jobs_dir).free
+    if disk_quota_bytes > 0:
+        over = max(over, usage - disk_quota_bytes)
+    if over <= 0:
+        return
+
+    print(f"Disk quota: {usage / 1024 ** 3:.1f} GB used, evicting least recently used artefacts..")
+    for last_used, rank, size, name, paths in sorted(artefacts, key=lambda artefact: artefact[:2]):
+        if over <= 0:
+            break
+        if size <= 0 or time.time() - last_used < eviction_grace_seconds:
+            continue
+        print(f"Disk quota: evicting {name} ({size / 1024 ** 2:.0f} MB, unused for {(time.time() - last_used) / 3600:.1f} h)..")
+        for path in paths:
+            trash_path(path)
+        if rank == 2:
+            with jobs_lock:
+                jobs.pop(os.path.basename(paths[0]), None)
+        over -= size
+    if over > 0:
+        print(f"Disk quota: still {over / 1024 ** 3:.1f} GB over, the rest is in use..")
+
+
+
+# Housekeeper thread target: empty the trash when woken, and enforce the disk quota every housekeeping_interval
+def housekeeping_loop():
+    while True:
+        try:
+            empty_trash()
+            if time.time() - housekeeper["last_scan"] >= housekeeping_interval:
+                housekeeper["last_scan"] = time.time()
+                enforce_disk_quota()
+                # evicted artefacts went to the trash
+                empty_trash()
+        except Exception as error:
+            print("An exception occurred in the housekeeper:", error)
+        housekeeper["wake"].wait(housekeeping_interval)
+        housekeeper["wake"].clear()
+
+
+
+# Start the housekeeper thread once, also an A1111 app started callback
+def start_housekeeper(demo=None, app=None):
+    with housekeeper_lock:
+        if housekeeper["thread"] is None:
+            housekeeper["thread"] = threading.Thread(target=housekeeping_loop, daemon=True)
+            housekeeper["thread"].start()
+
+
+
+# Path, size and modification time of the ffmpeg binary on PATH, a new binary invalidates the capabilities cache
+def ffmpeg_binary_fingerprint():
+    path = shutil.which("ffmpeg")
+    if path is None:
+        raise Exception("ffmpeg not found, install it and add it to your PATH.")
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    return {"path": path, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+
+# Names listed by ffmpeg -encoders or -filters
+def ffmpeg_list(kind):
+    command = ["ffmpeg", "-hide_banner", f"-{kind}"]
+    output = subprocess.run(command, stdin=subprocess.DEVNULL, capture_output=True, text=True).stdout
+    names = []
+    for line in output.splitlines():
+        parts = line.split()
+        # entries are capability flags then name, legend lines are "flags = meaning"
+        if len(parts) >= 2 and parts[1] != "=" and re.fullmatch(r"[A-Z.|]+", parts[0]):
+            names.append(parts[1])
+    return sorted(names)
+
+
+
+# ffmpeg version, encoders and filters, probed on first use and cached in ffmpeg_capabilities.json
+# The cache holds while the ffmpeg binary on PATH is the same file, so startup and jobs don't run ffmpeg to find out
+def ffmpeg_capabilities():
+    binary = ffmpeg_binary_fingerprint()
+    with ffmpeg_capabilities_lock:
+        if ffmpeg_capabilities_cache.get("binary") == binary:
+            return ffmpeg_capabilities_cache
+        try:
+            with open(ffmpeg_capabilities_path, 'r') as file:
+                capabilities = json.load(file)
+        except (OSError, ValueError):
+            capabilities = {}
+
+        if capabilities.get("binary") != binary:
+            print('Probing ffmpeg capabilities..')
+            version = subprocess.run(["ffmpeg", "-version"], stdin=subprocess.DEVNULL, capture_output=True, text=True).stdout
+            capabilities = {"binary": binary, "version": (version.splitlines() or ["unknown"])[0],
+                            "encoders": ffmpeg_list("encoders"), "filters": ffmpeg_list("filters")}
+            try:
+                with open(ffmpeg_capabilities_path, 'w') as file:
+                    json.dump(capabilities, file, indent=2)
+            except OSError as error:
+                print(f"ffmpeg capabilities not cached: {error}")
+            print(f"{capabilities['version']}: {len(capabilities['encoders'])} encoders, "
+                  f"{len(capabilities['filters'])} filters..")
+
+        ffmpeg_capabilities_cache.clear()
+        ffmpeg_capabilities_cache.update(capabilities)
+        return ffmpeg_capabilities_cache
+
+
+
+# Missing encoders and filters of the ffmpeg build, raising with all of them when raise_error is set
+# Jobs check first, so a build without libx264 or libwebp fails before any work instead of halfway
+def require_ffmpeg(encoders=(), filters=(), raise_error=True):
+    capabilities = ffmpeg_capabilities()
+    missing = ([f"the {name} encoder" for name in encoders if name not in capabilities["encoders"]]
+               + [f"the {name} filter" for name in filters if name not in capabilities["filters"]])
+    if missing and raise_error:
+        raise Exception(f"Your ffmpeg build ({capabilities['version']}) lacks {', '.join(missing)}.")
+    return missing
+
+
+
+# Probe duration in seconds, frame rate, size and frame count of the first video stream, and the first audio codec
+# Raises when ffprobe can't read the file or finds no video in it
+def probe_video(video_path):
+    command = ["ffprobe", "-v", "error",
+               "-show_entries", "stream=codec_type,codec_name,width,height,avg_frame_rate,r_frame_rate,nb_frames"
+               ":stream_disposition=attached_pic:format=duration,format_name", "-of", "json", video_path]
+    result = subprocess.run(command, stdin=subprocess.DEVNULL, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise Exception(f"ffprobe can't read the video: {result.stderr.strip()}")
+    probe = json.loads(result.stdout)
+    streams = probe.get("streams", [])
+    # cover art of audio files is a video stream too
+    videos = [stream for stream in streams if stream.get("codec_type") == "video" and stream.get("width")
+              and not stream.get("disposition", {}).get("attached_pic")]
+    audios = [stream for stream in streams if stream.get("codec_type") == "audio"]
+    if not videos:
+        raise Exception("The uploaded file has no video stream ffmpeg can read.")
+    stream = videos[0]
+
+    # average rate first, for variable frame rate videos, rates are 0/0 when unknown
+    fps = Fraction(0)
+    for key in ["avg_frame_rate", "r_frame_rate"]:
+        if fps <= 0 and re.fullmatch(r"\d+/[1-9]\d*", stream.get(key, "")):
+            fps = Fraction(stream[key])
+    if fps <= 0:
+        raise Exception("Could't find the frame rate of the video.")
+    if probe.get("format", {}).get("duration", "N/A") != "N/A":
+        duration = float(probe["format"]["duration"])
+    elif str(stream.get("nb_frames", "")).isdigit():
+        duration = float(int(stream["nb_frames"]) / fps)
+    else:
+        raise Exception("Could't find the duration of the video.")
+    # nb_frames is only in some containers' headers
+    frames = int(stream["nb_frames"]) if str(stream.get("nb_frames", "")).isdigit() else round(duration * fps)
+
+    return {"duration": duration, "width": int(stream["width"]), "height": int(stream["height"]),
+            "fps": str(fps), "frames": frames, "codec": stream.get("codec_name"),
+            "audio": audios[0].get("codec_name") if audios else None,
+            "container": probe.get("format", {}).get("format_name")}
+
+
+
+# Probe the saved video of a job once, later calls read the result back from video.json
+def probe_input_video(job, video_path):
+    size = os.path.getsize(video_path)
+    if os.path.exists(job.video_probe_path):
+        with open(job.video_probe_path, 'r') as file:
+            video = json.load(file)
+        if video["filename"] == os.path.basename(video_path) and video["size"] == size:
+            return video
+
+    video = probe_video(video_path)
+    video["filename"] = os.path.basename(video_path)
+    video["size"] = size
+    with open(job.video_probe_path, 'w') as file:
+        json.dump(video, file, indent=2)
+    print(f"Video probed: {video['container']} {video['width']}x{video['height']}, {float(Fraction(video['fps'])):.3f} fps, "
+          f"{video['frames']} frames, {video['duration']:.1f} s, audio {video['audio'] or 'none'}..")
+    return video
+
+
+
+# Frame rate frames of a probed video are extracted at: its own rate, divided by the smallest
+# integer bringing it down to max_extract_fps, so frames are only dropped and never duplicated
+def extract_rate(video):
+    fps = Fraction(video["fps"])
+    return fps / math.ceil(fps / max_extract_fps)
+
+
+
+# Frame rate of the extracted frames of a manifest, manifests written before it was recorded were extracted at 25 fps
+def manifest_rate(manifest):
+    return Fraction(manifest.get("fps", "25"))
+
+
+
+# Frame rate of the created video, the rate of the extracted frames when fps is 0
+def output_rate(manifest, fps=0):
+    if fps and float(fps) > 0:
+        return Fraction(fps).limit_denominator(1001)
+    return manifest_rate(manifest)
+
+
+
+# Probe codec and duration of the first audio track of a file, None when it has no audio
+def probe_audio(file_path):
+    command = ["ffprobe", "-v", "error", "-select_streams", "a:0",
+               "-show_entries", "stream=codec_name:format=duration", "-of", "json", file_path]
+    probe = json.loads(subprocess.check_output(command, text=True))
+    if not probe.get("streams"):
+        return None
+    return {"codec": probe["streams"][0]["codec_name"], "duration": float(probe["format"]["duration"])}
+
+
+
+# Demux the first audio track of the video as a stream copy, muxed back into the output by combine_frames
+# Videos are still created without audio if it can't be extracted
+def extract_audio(job, video_path):
+    if os.path.exists(job.audio_path):
+        os.remove(job.audio_path)
+    if probe_input_video(job, video_path)["audio"] is None:
+        print('No audio track in the video..')
+        return False
+
+    print('Extracting audio..')
+    start_progress(job, "Extracting audio", 0)
+    command = ["ffmpeg", "-y", "-i", video_path, "-map", "0:a:0", "-c", "copy", job.audio_path]
+    if run_ffmpeg(command, job) != 0:
+        check_cancelled(job)
+        print("Could't extract audio with ffmpeg, the video will be created without audio..")
+        if os.path.exists(job.audio_path):
+            os.remove(job.audio_path)
+        return False
+    return True
+
+
+
+# ffmpeg inputs and output options muxing the extracted audio into a video of duration seconds, in the same pass
+# Audio is stream copied and trimmed when mp4 takes its codec and it's long enough, else encoded to AAC and padded with silence
+def audio_mux_options(job, duration):
+    audio = probe_audio(job.audio_path) if os.path.exists(job.audio_path) else None
+    if audio is None:
+        return [], []
+    # rounded up, so the last frame isn't cut
+    duration = math.ceil(duration * 1000) / 1000
+    options = ["-map", "0:v", "-map", "1:a"]
+    if audio["codec"] in mp4_audio_codecs and audio["duration"] >= duration:
+        options += ["-c:a", "copy"]
+    else:
+        # Fraunhofer AAC sounds better than ffmpeg's own, when the build has it
+        encoder = "libfdk_aac" if not require_ffmpeg(["libfdk_aac"], raise_error=False) else "aac"
+        options += ["-c:a", encoder, "-af", "apad"]
+    return ["-i", job.audio_path], options + ["-t", str(duration)]
+
+
+
+# Frame size fitting inside target width and height, keeping aspect ratio, in multiples of align
+# A target of 0 leaves that side free, frames are only scaled down; returns None when no scaling is needed
+# Each side goes to the nearest multiple of align, or the one below when the nearest is past the target or the
+# source, so the ratio drifts a little: source_crop trims the source to the exact ratio of the frame size
+def fit_frame_size(width, height, target_width=0, target_height=0, align=8):
+    # exact ratios, so a side landing on its target isn't rounded one step down
+    scales = [Fraction(target, side) for target, side in [(target_width, width), (target_height, height)] if target > 0]
+    if not scales or min(scales) >= 1:
+        return None
+    scale = min(scales)
+    frame_size = []
+    for side, target in [(width, target_width), (height, target_height)]:
+        limit = min(target, side) if target > 0 else side
+        aligned = max(align, round(side * scale / align) * align)
+        frame_size.append(aligned if aligned <= limit else max(align, math.floor(side * scale / align) * align))
+    return frame_size
+
+
+
+# Centered region of the source with the aspect ratio of frame_size, as [width, height, x, y] source pixels
+# Scaling it to frame_size keeps the picture undistorted; returns None when the whole source already fits
+def source_crop(width, height, frame_size):
+    if frame_size is None:
+        return None
+    crop_width = min(width, round(height * Fraction(frame_size[0], frame_size[1])))
+    crop_height = min(height, round(width * Fraction(frame_size[1], frame_size[0])))
+    if [crop_width, crop_height] == [width, height]:
+        return None
+    return [crop_width, crop_height, (width - crop_width) // 2, (height - crop_height) // 2]
+
+
+
+# File extension and ffmpeg encoder options of an intermediate frame format
+# png_level is zlib compression (0 fastest, 6 ffmpeg default), quality goes from 1 to 100 for JPEG and WebP
+def frame_format_options(frame_format="PNG", png_level=6, quality=90):
+    if frame_format == "JPEG":
+        # mjpeg qscale goes from 2 (best) to 31
+        return "jpg", ["-q:v", str(round(2 + (100 - quality) * 29 / 100))]
+    if frame_format == "WebP":
+        return "webp", ["-c:v", "libwebp", "-quality", str(int(quality))]
+    if frame_format == "WebP lossless":
+        return "webp", ["-c:v", "libwebp", "-lossless", "1", "-compression_level", "1"]
+    return "png", ["-compression_level", str(int(png_level))]
+
+
+
+# ffmpeg output options sampling the video at rate frames per second, scaled to frame_size in the same decode pass
+# Frames are picked on the timeline of the whole video, frame k being the one shown at k / rate, so a range of
+# extract_ranges starting at frame start gets the same frames a sequential extraction would
+def extract_filter(keyframe_interval=1, frame_size=None, rate=25, start=0, crop=None):
+    filters = [f"fps={rate}"]
+    if start:
+        # frames decoded before the range, its input is seeked a little early
+        filters.append(f"trim=start_pts={start}")
+    if keyframe_interval > 1:
+        # keep only every Nth frame of the rate timeline, numbered consecutively
+        filters.append(f"select='not(mod(pts\\,{keyframe_interval}))'")
+    if crop is not None:
+        # trim the source to the aspect ratio of frame_size, see source_crop
+        filters.append("crop={}:{}:{}:{}".format(*crop))
+    if frame_size is not None:
+        filters.append(f"scale={frame_size[0]}:{frame_size[1]}:flags=lanczos")
+    return ["-vf", ",".join(filters), "-vsync", "vfr"]
+
+
+
+# Extract frames in parallel from time ranges of the video, each worker writing its own slice of the numbering
+# Ranges are (start, length) in frames at rate aligned to the keyframe interval, so each worker's
+# first frame lands on the same output frame a single sequential extraction would produce
+def extract_ranges(video_path, file_path_pattern, ranges, keyframe_interval=1, format_options=None, frame_size=None, job=None,
+                   rate=25, crop=None):
+    print(f"Extracting frames with {len(ranges)} workers..")
+
+    def extract_range(index, start, length):
+        # the last range runs to the end of the video, catching any frames past the probed duration
+        frames_limit = ["-frames:v", str(length // keyframe_interval)] if index < len(ranges) - 1 else []
+        # seek a second before the range keeping the video timestamps, extract_filter cuts the range at its first frame
+        # on the same timeline as a sequential extraction, wherever ffmpeg lands and however the seek time is rounded
+        seek = ["-ss", str(float(max(0, start / rate - 1))), "-copyts", "-start_at_zero"] if start else []
+        command = (["ffmpeg"] + seek + ["-i", video_path]
+                   + extract_filter(keyframe_interval, frame_size, rate, start, crop)
+                   + (format_options or []) + frames_limit + ["-start_number", str(start // keyframe_interval + 1), file_path_pattern])
+        return_code = run_ffmpeg(command, job)
+        print(f"Range {index + 1}/{len(ranges)} extracted..")
+        return return_code
+
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        futures = [executor.submit(extract_range, index, start, length)
+                   for index, (start, length) in enumerate(ranges)]
+        return_codes = [future.result() for future in futures]
+
+    return max(return_codes)
+
+
+
+# Frames of the rate timeline where a new shot starts, those ffmpeg scores above threshold (0 to 1) as a scene change
+# Scored on small copies of the frames in their own decode pass, cuts closer than min_shot_seconds are dropped
+def detect_scene_cuts(job, video_path, rate, threshold):
+    log_path = os.path.join(job.input_video_dir, "scenes.log")
+    # setpts=N stamps each frame with its number on the rate timeline, showinfo logs the frames past the threshold
+    command = ["ffmpeg", "-i", video_path, "-an", "-sn",
+               "-vf", f"fps={rate},setpts=N,scale=256:-2,select='gt(scene\\,{float(threshold)})',showinfo",
+               "-f", "null", "-"]
+    return_code = run_ffmpeg(command, job, log_path)
+    with open(log_path, 'r', errors="replace") as file:
+        log = file.read()
+    os.remove(log_path)
+    if return_code != 0:
+        raise Exception("Could't detect scene cuts with ffmpeg.")
+
+    cuts = []
+    min_shot_frames = math.ceil(min_shot_seconds * rate)
+    for match in re.finditer(r"Parsed_showinfo.*?\bpts:\s*(\d+)", log):
+        frame = int(match.group(1))
+        if frame - (cuts[-1] if cuts else 0) >= min_shot_frames:
+            cuts.append(frame)
+    return cuts
+
+
+
+# Shots as [start, end) ranges of extracted frames, each one starting at the first keyframe after its cut
+def shot_ranges(cuts, frame_count, keyframe_interval=1):
+    starts = sorted({0} | {math.ceil(cut / keyframe_interval) for cut in cuts})
+    starts = [start for start in starts if start < frame_count]
+    return [[start, end] for start, end in zip(starts, starts[1:] + [frame_count])]
+
+
+
+# Link the frames of each shot into its own numbered img2img batch folder, listed in shots.json
+# Every shot is generated to the same output folder, create_video encodes them separately
+def write_shot_batches(job, manifest):
+    trash_path(job.shots_dir)
+    if not manifest.get("shots"):
+        return []
+
+    frame_duration = manifest.get("keyframe_interval", 1) / manifest_rate(manifest)
+    shots = []
+    for index, (start, end) in enumerate(manifest["shots"]):
+        shot_dir = os.path.join(job.shots_dir, f"shot{index + 1:03d}")
+        os.makedirs(shot_dir)
+        frames = [filename for filename in manifest["frames"][start:end] if filename not in manifest["duplicates"]]
+        for filename in frames:
+            link_or_copy(os.path.join(job.frames_dir, filename), os.path.join(shot_dir, filename))
+        shots.append({"shot": index + 1, "frames_dir": add_slash(shot_dir), "frames": len(frames),
+                      "first_frame": manifest["frames"][start], "last_frame": manifest["frames"][end - 1],
+                      "start": round(float(start * frame_duration), 3), "end": round(float(end * frame_duration), 3)})
+
+    with open(os.path.join(job.shots_dir, "shots.json"), 'w') as file:
+        json.dump(shots, file, indent=2)
+    print(f"Frames split in {len(shots)} shots..")
+    return shots
+
+
+
+# Shots of a job listed by write_shot_batches, empty when it wasn't split at scene cuts
+def read_shot_batches(job):
+    shots_path = os.path.join(job.shots_dir, "shots.json")
+    if not os.path.exists(shots_path):
+        return []
+    with open(shots_path, 'r') as file:
+        return json.load(file)
+
+
+
+# Extract frames with ffmpeg to frames directory, and write the frames manifest
+# With a scene threshold, the manifest also lists the shots frames are split in
+def extract_video_frames(job, video_path, dedup=False, dedup_threshold=2, keyframe_interval=1, extract_workers=1,
+                         frame_format="PNG", png_level=6, frame_quality=90, target_width=0, target_height=0, size_align=8,
+                         scene_threshold=0):
+    extension, format_options = frame_format_options(frame_format, png_level, frame_quality)
+    file_path_pattern = os.path.join(job.frames_dir,f"frame%4d.{extension}")
+
+    # downscale in the decode pass, so img2img doesn't get frames bigger than it will generate
+    video = probe_input_video(job, video_path)
+    rate = extract_rate(video)
+    print(f"Extracting frames at {float(rate):.3f} fps..")
+    frame_size = fit_frame_size(video["width"], video["height"], int(target_width), int(target_height), int(size_align))
+    crop = source_crop(video["width"], video["height"], frame_size)
+    if frame_size is not None:
+        print(f"Scaling frames from {video['width']}x{video['height']} to {frame_size[0]}x{frame_size[1]}..")
+    if crop is not None:
+        print(f"Cropping frames to the centered {crop[0]}x{crop[1]} of the video, keeping its aspect ratio..")
+    start_progress(job, "Extracting frames", video["duration"])
+
+    ranges = []
+    if int(extract_workers) > 1:
+        total_frames = math.ceil(video["frames"] * rate / Fraction(video["fps"]))
+        ranges = split_segments(total_frames, int(extract_workers), keyframe_interval)
+
+    with measure_stage(job, "extract") as record:
+        if len(ranges) > 1:
+            return_code = extract_ranges(video_path, file_path_pattern, ranges, keyframe_interval, format_options, frame_size, job,
+                                         rate, crop)
+        else:
+            command = (["ffmpeg", "-i", video_path] + extract_filter(keyframe_interval, frame_size, rate, crop=crop)
+                       + format_options + ["-start_number", "0001", file_path_pattern])
+            return_code = run_ffmpeg(command, job)
         if return_code == 0:
             print('Frames extracted successfully..')
         else:
             raise Exception("Could't extract frames with ffmpeg.")
+        record["frames"] = len(os.listdir(job.frames_dir))
+        record["bytes_read"] = os.path.getsize(video_path)
+        record["bytes_written"] = directory_size(job.frames_dir)
+        record["frame_format"] = frame_format
+
+    message = "Frames extracted successfully.."
+    manifest = {"frames": sorted(os.listdir(job.frames_dir), key=frame_number), "duplicates": {},
+                "keyframe_interval": keyframe_interval, "frame_format": frame_format,
+                "fps": str(rate), "source_fps": video["fps"],
+                "source_size": [video["width"], video["height"]],
+                "frame_size": frame_size or [video["width"], video["height"]]}
+    if crop is not None:
+        # region of the source in the frames, the size "Source video" output goes back to
+        manifest["source_crop"] = crop
+    if dedup:
+        print('Removing near-duplicate frames..')
+        start_progress(job, "Removing near-duplicate frames", 0)
+        with measure_stage(job, "dedup") as record:
+            manifest["duplicates"] = remove_duplicate_frames(job.frames_dir, job.frames_duplicates_dir, dedup_threshold)
+            record["frames"] = len(manifest["frames"])
+            record["duplicates"] = len(manifest["duplicates"])
+        message = f"Frames extracted successfully.. {len(manifest['duplicates'])} of {len(manifest['frames'])} near-duplicate frames skipped."
+        print(message)
+    if float(scene_threshold) > 0:
+        print('Detecting scene cuts..')
+        start_progress(job, "Detecting scene cuts", video["duration"])
+        with measure_stage(job, "scenes") as record:
+            cuts = detect_scene_cuts(job, video_path, rate, scene_threshold)
+            manifest["shots"] = shot_ranges(cuts, len(manifest["frames"]), keyframe_interval)
+            manifest["scene_threshold"] = float(scene_threshold)
+            record["bytes_read"] = os.path.getsize(video_path)
+            record["shots"] = len(manifest["shots"])
+        message = f"{message} {len(manifest['shots'])} shots found at scene cuts."
+        print(message)
+    write_frames_manifest(job, manifest)
+    return message
+
+
+
+# Extract frames of the saved video, or restore them from the frames cache
+# Frames of each shot are then linked into their own img2img batch folders when split at scene cuts
+def prepare_frames(job, video_path, dedup=False, dedup_threshold=2, keyframe_interval=1, extract_workers=1, use_cache=True,
+                   frame_format="PNG", png_level=6, frame_quality=90, target_width=0, target_height=0, size_align=8,
+                   scene_threshold=0):
+    require_ffmpeg([frame_format_encoders[frame_format]], ["fps", "select", "scale"])
+    if float(scene_threshold) > 0:
+        require_ffmpeg(filters=["setpts", "showinfo"])
+    with measure_stage(job, "audio") as record:
+        record["audio"] = extract_audio(job, video_path)
+        if record["audio"]:
+            record["bytes_written"] = os.path.getsize(job.audio_path)
+    check_cancelled(job)
+
+    cache_key = None
+    if use_cache:
+        start_progress(job, "Looking for previously extracted frames", 0)
+        # extract_workers is left out, it doesn't change the extracted frames
+        extension, format_options = frame_format_options(frame_format, png_level, frame_quality)
+        with measure_stage(job, "hash_video") as record:
+            cache_key = frames_cache_key(video_path, {"dedup": bool(dedup),
+                                                      "dedup_threshold": float(dedup_threshold) if dedup else None,
+                                                      "keyframe_interval": keyframe_interval,
+                                                      "frame_format": [extension, " ".join(format_options)],
+                                                      "target_size": [int(target_width), int(target_height), int(size_align)],
+                                                      "max_extract_fps": max_extract_fps,
+                                                      # frames picked on the video timeline by extract_filter, entries
+                                                      # extracted before may hold frames shifted by parallel ranges
+                                                      "sampling": "timeline",
+                                                      # left out when off, so earlier cache entries still match
+                                                      **({"scene_threshold": float(scene_threshold)}
+                                                         if float(scene_threshold) > 0 else {})})
+            record["bytes_read"] = os.path.getsize(video_path)
+    check_cancelled(job)
+
+    if cache_key is not None:
+        with measure_stage(job, "restore_cache") as record:
+            record["hit"] = restore_cached_frames(job, cache_key)
+            if record["hit"]:
+                record["frames"] = len(os.listdir(job.frames_dir))
+        if record["hit"]:
+            message = "Frames restored from a previous extraction of this video.."
+            print(message)
+            write_shot_batches(job, read_frames_manifest(job))
+            return message
+
+    message = extract_video_frames(job, video_path, dedup, dedup_threshold, keyframe_interval, extract_workers,
+                                   frame_format, png_level, frame_quality, target_width, target_height, size_align,
+                                   scene_threshold)
+    if cache_key is not None:
+        with measure_stage(job, "store_cache") as record:
+            store_cached_frames(job, cache_key)
+            record["frames"] = len(os.listdir(job.frames_dir))
+    write_shot_batches(job, read_frames_manifest(job))
+    return message
+
+
+
+# Extract frames from video, streaming ffmpeg progress to the output message
+def extract_frames(videofile, dedup=False, dedup_threshold=2, keyframe_interval=1, extract_workers=1, use_cache=True,
+                   frame_format="PNG", png_level=6, frame_quality=90, target_width=0, target_height=0, size_align=8,
+                   scene_threshold=0, job_id=None):
+    job = None
+    try:
+        # a new upload replaces the previous video of this session
+        if job_id:
+            try:
+                remove_job(get_job(job_id))
+            except Exception as error:
+                print(f"Previous job not removed: {error}")
+        job = create_job()
+
+        keyframe_interval = int(keyframe_interval)
+
+        def work():
+            # Saves video in directory
+            start_progress(job, "Saving video", 0)
+            with measure_stage(job, "save_video") as record:
+                video_path = save_video(job, videofile)
+                # a linked video wasn't read or written
+                record["linked"] = os.stat(video_path).st_nlink > 1
+                record["bytes_read"] = record["bytes_written"] = 0 if record["linked"] else os.path.getsize(video_path)
+            return prepare_frames(job, video_path, dedup, dedup_threshold, keyframe_interval, extract_workers, use_cache,
+                                  frame_format, png_level, frame_quality, target_width, target_height, size_align,
+                                  scene_threshold)
+
+        # progress rows already hold the new job, so it can be cancelled
+        message = yield from stream_progress(job, work, lambda progress: [progress] + [gr.update()] * 13 + [job.job_id])
+        shots = shot_choices(job)
+
+        yield [message, gr.update(visible=True),
+               gr.update(value=add_slash(job.frames_dir), visible=True),
+               gr.update(value=add_slash(job.frames_generated_dir), visible=True),
+               gr.update(visible=True), gr.update(visible=True),
+               gr.update(visible=True), gr.update(visible=True),
+               gr.update(visible=keyframe_interval > 1), gr.update(visible=keyframe_interval == 1),
+               gr.update(visible=True), gr.update(visible=True),
+               gr.update(visible=True), gr.update(choices=shots, value=shots[0], visible=len(shots) > 1), job.job_id]
+
+    except Exception as error:
+
+        message = f"An exception occurred: {error}"
+        if job is not None and job.cancelled.is_set():
+            message = "Extraction cancelled, partial frames removed.."
+        print(message)
+        if job is not None:
+            remove_job(job)
+        yield [message, gr.update(visible=False),
+               gr.update(visible=False), gr.update(visible=False),
+               gr.update(visible=False), gr.update(visible=False),
+               gr.update(visible=False), gr.update(visible=False),
+               gr.update(visible=False), gr.update(visible=False),
+               gr.update(visible=False), gr.update(visible=False),
+               gr.update(visible=False), gr.update(visible=False), None]
+
+
+
+# Choices of the img2img input selector: all frames, then each shot split at scene cuts
+def shot_choices(job):
+    return ["All frames"] + [f"Shot {shot['shot']}: {shot['first_frame']} - {shot['last_frame']} ({shot['frames']} frames)"
+                             for shot in read_shot_batches(job)]
 
-        return ["Frames extracted successfully..", gr.update(visible=True),
-                gr.update(visible=True), gr.update(visible=True),
-                gr.update(visible=True), gr.update(visible=True),
-                gr.update(visible=True), gr.update(visible=True)]
+
+
+# Point img2img batch input to the frames of one shot, or back to all frames
+def select_shot(shot="All frames", job_id=None):
+    try:
+        job = get_job(job_id)
+        match = re.match(r"Shot (\d+):", shot or "")
+        if match is None:
+            return ["img2img input: all frames..", gr.update(value=add_slash(job.frames_dir))]
+        shots = read_shot_batches(job)
+        frames_dir = shots[int(match.group(1)) - 1]["frames_dir"]
+        return [f"img2img input: shot {match.group(1)} of {len(shots)}..", gr.update(value=frames_dir)]
 
     except Exception as error:
+        print("An exception occurred:", error)
+        return [f"An exception occurred: {error}", gr.update()]
+
+
+
+# Average PSNR of extracted frames against the video they come from, inf when lossless
+def frames_psnr(video_path, file_path_pattern, seconds, rate=25):
+    command = ["ffmpeg", "-t", str(seconds), "-i", video_path, "-framerate", str(rate), "-start_number", "1",
+               "-i", file_path_pattern,
+               "-lavfi", f"[0:v]fps={rate},format=rgb24[reference];[1:v]format=rgb24[frames];[frames][reference]psnr", "-f", "null", "-"]
+    with ffmpeg_slot("psnr"):
+        output = subprocess.run(command, stdin=subprocess.DEVNULL, capture_output=True, text=True).stderr
+    match = re.search(r"average:(inf|[\d.]+)", output)
+    return float(match.group(1)) if match else None
 
+
+
+# Extract the start of a video in each intermediate frame format, reporting seconds, disk usage and PSNR
+def compare_frame_formats(videofile):
+    try:
+        if videofile is None:
+            raise Exception("No video file uploaded.")
+        video_path = videofile.name
+        rate = extract_rate(probe_video(video_path))
+        lines = [f"Frame formats on the first {format_benchmark_seconds} seconds:"]
+        for frame_format, png_level, quality in format_benchmark_settings:
+            extension, format_options = frame_format_options(frame_format, png_level, quality)
+            name = f"{frame_format} (level {png_level})" if frame_format == "PNG" else f"{frame_format} (quality {quality})"
+            if require_ffmpeg([frame_format_encoders[frame_format]], raise_error=False):
+                lines.append(f"{name}: not available in your ffmpeg build")
+                continue
+            benchmark_dir = tempfile.mkdtemp(prefix="format_benchmark_", dir=base_dir)
+            try:
+                file_path_pattern = os.path.join(benchmark_dir, f"frame%4d.{extension}")
+                start_time = time.perf_counter()
+                command = (["ffmpeg", "-t", str(format_benchmark_seconds), "-i", video_path, "-r", str(rate)]
+                           + format_options + ["-start_number", "0001", file_path_pattern])
+                if run_ffmpeg(command) != 0:
+                    lines.append(f"{name}: extraction failed, is the encoder available in your ffmpeg?")
+                    continue
+                seconds = time.perf_counter() - start_time
+                megabytes = directory_size(benchmark_dir) / 1024 ** 2
+                psnr = frames_psnr(video_path, file_path_pattern, format_benchmark_seconds, rate)
+                psnr_text = "n/a" if psnr is None else ("lossless" if math.isinf(psnr) else f"{psnr:.1f} dB")
+                lines.append(f"{name}: {seconds:.1f} s, {megabytes:.1f} MB, PSNR {psnr_text}")
+            finally:
+                shutil.rmtree(benchmark_dir, ignore_errors=True)
+
+        message = "\n".join(lines)
+        print(message)
+        return message
+
+    except Exception as error:
         print("An exception occurred:", error)
-        return [f"An exception occurred: {error}", gr.update(visible=False),
-                gr.update(visible=False), gr.update(visible=False),
-                gr.update(visible=False), gr.update(visible=False),
-                gr.update(visible=False), gr.update(visible=False)]
+        return f"An exception occurred: {error}"
 
 
 
-# Combine frames to video
-def combine_frames(fps):
+# Video filter scaling generated frames for the output video: kept as generated, back to the
+# source video size, or to a custom size (0 keeps aspect ratio for that side)
+# Frames cropped to keep their aspect ratio go back to the size of their region of the source, see source_crop
+def output_scale_filter(manifest, output_size="Generated frames", output_width=0, output_height=0):
+    if output_size == "Source video" and "source_size" in manifest:
+        width, height = manifest.get("source_crop", manifest["source_size"])[:2]
+    elif output_size == "Custom" and (int(output_width) > 0 or int(output_height) > 0):
+        width, height = int(output_width) or -2, int(output_height) or -2
+    else:
+        return ""
+    # libx264 needs even sizes
+    width, height = [side - side % 2 if side > 0 else side for side in (width, height)]
+    return f"scale={width}:{height}:flags=lanczos,"
+
+
+
+# Video filter rebuilding frames between keyframes extracted every Nth frame
+# "blend" crossfades neighbour keyframes, "motion" uses motion compensated interpolation (slower)
+def interpolation_filter(keyframe_interval, target_fps, interpolation="blend"):
+    if keyframe_interval <= 1:
+        return ""
+    mi_mode = "mci" if interpolation == "motion" else "blend"
+    return f"minterpolate=fps={target_fps}:mi_mode={mi_mode},"
+
+
+
+# Options starting a process in its own process group, so it can be killed with its children
+def process_group_options():
+    if os.name == "nt":
+        return {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {"start_new_session": True}
+
+
+
+# Kill a process and all its children
+def kill_process_tree(process):
+    if process.poll() is not None:
+        return
     try:
-        print("Frames per second selected:",fps);
+        if os.name == "nt":
+            subprocess.call(["taskkill", "/F", "/T", "/PID", str(process.pid)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        process.kill()
+
+
+
+# Numbers of one ffmpeg -progress report, N/A values left out
+def parse_progress(report):
+    progress = {}
+    for key, name in [("frame", "frame"), ("fps", "fps"), ("speed", "speed"), ("out_time_us", "out_time")]:
+        try:
+            progress[name] = float(report.get(key, "").rstrip("x"))
+        except ValueError:
+            continue
+    if "out_time" in progress:
+        progress["out_time"] = max(0, progress["out_time"] / 1000000)
+    return progress
+
+
+
+# Reset ffmpeg progress of a job for a new stage, going through total seconds of video (0 when unknown)
+def start_progress(job, stage, total):
+    job.progress = {"stage": stage, "total": total, "done": 0, "frames": 0, "processes": {}, "start": time.perf_counter()}
+
+
+
+# Progress of the running stage of a job: frames, fps and speed of all its ffmpeg processes, and ETA
+def progress_message(job):
+    progress = job.progress
+    if progress["stage"] is None:
+        return "Waiting.."
+    running = list(progress["processes"].values())
+    frames = progress["frames"] + sum(report.get("frame", 0) for report in running)
+    if not running and frames == 0:
+        return f"{progress['stage']}.."
+
+    fps = sum(report.get("fps", 0) for report in running)
+    speed = sum(report.get("speed", 0) for report in running)
+    message = f"{progress['stage']}: {int(frames)} frames, {fps:.1f} fps, speed {speed:.2f}x"
+    done = progress["done"] + sum(report.get("out_time", 0) for report in running)
+    if progress["total"] > 0 and done > 0:
+        fraction = min(1, done / progress["total"])
+        eta = (time.perf_counter() - progress["start"]) * (1 - fraction) / fraction
+        message += f", {fraction:.0%} done, ETA {int(eta // 60)}:{int(eta % 60):02d}"
+    return message
+
+
+
+# Raise if the job was cancelled, between stages that don't run ffmpeg
+def check_cancelled(job):
+    if job is not None and job.cancelled.is_set():
+        raise Exception("Cancelled.")
+
+
+
+# Run an ffmpeg command in a scheduler slot, returning its exit code
+# Its progress is reported to the job, which can kill it with cancel_job
+# Its log goes to the console, or to log_path for commands whose log is read afterwards
+def run_ffmpeg(command, job=None, log_path=None):
+    with ffmpeg_slot("ffmpeg"):
+        if job is not None and job.cancelled.is_set():
+            return 1
+        command = [command[0], "-progress", "pipe:1", "-nostats"] + command[1:]
+        print(shlex.join(command))
+        log_file = open(log_path, 'w') if log_path is not None else None
+        try:
+            process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=log_file,
+                                       text=True, **process_group_options())
+        finally:
+            # ffmpeg has its own handle of the log file
+            if log_file is not None:
+                log_file.close()
+        if job is None:
+            process.stdout.read()
+            return process.wait()
+
+        job.processes.add(process)
+        # cancelled while starting
+        if job.cancelled.is_set():
+            kill_process_tree(process)
+        progress = job.progress
+        report = {}
+        try:
+            for line in process.stdout:
+                key, _, value = line.strip().partition("=")
+                report[key] = value
+                if key == "progress":
+                    progress["processes"][process.pid] = parse_progress(report)
+            return process.wait()
+        finally:
+            job.processes.discard(process)
+            finished = progress["processes"].pop(process.pid, {})
+            job.ffmpeg_runs.append(finished)
+            progress["done"] += finished.get("out_time", 0)
+            progress["frames"] += finished.get("frame", 0)
+
+
+
+# Run work for a job in a background thread, kept in job.task
+def start_task(job, work):
+    job.cancelled.clear()
+    executor = ThreadPoolExecutor(max_workers=1)
+    job.task = executor.submit(work)
+    executor.shutdown(wait=False)
+    return job.task
+
+
+
+# Run work in a background thread, yielding UI rows with the job's progress until it's done
+# Returns the result of work, or raises its exception
+def stream_progress(job, work, progress_row):
+    start_task(job, work)
+    while True:
+        try:
+            return job.task.result(timeout=progress_interval)
+        except FutureTimeoutError:
+            yield progress_row(progress_message(job))
+
+
+
+# Cancel the running extraction, video creation or watch mode of a job, killing its ffmpeg processes
+def cancel_job(job_id=None):
+    try:
+        job = get_job(job_id)
+        running = job.task is not None and not job.task.done()
+        watching = job.watch["thread"] is not None and job.watch["thread"].is_alive()
+        if not running and not watching:
+            return "Nothing to cancel.."
+
+        job.cancelled.set()
+        job.watch["stop"].set()
+        job.watch["finish"].set()
+        for process in list(job.processes):
+            kill_process_tree(process)
+        print(f"Job {job.job_id} cancelled..")
+        return "Cancelling.."
+
+    except Exception as error:
+        print("An exception occurred:", error)
+        return f"An exception occurred: {error}"
+
+
+
+# Remove a partially written video and its segments after a cancelled encode
+# Encoded shots are kept for the next encode, partial ones are removed by encode_shots
+def remove_partial_video(job):
+    for filename in os.listdir(job.output_video_dir) if os.path.isdir(job.output_video_dir) else []:
+        if filename != "shots":
+            trash_path(os.path.join(job.output_video_dir, filename))
+    os.makedirs(job.output_video_dir, exist_ok=True)
+
+
+
+# Remove partially extracted frames after a cancelled or failed extraction, keeping the saved video
+def remove_partial_frames(job):
+    for path in [job.frames_dir, job.frames_duplicates_dir, job.shots_dir, job.frames_manifest_path]:
+        trash_path(path)
+    create_directories(job)
+
+
+
+# Remove extracted and generated frames and videos of a job before extracting it again, keeping the saved video
+# Folders are moved to the trash, so new frames get new files instead of writing into frames hardlinked from the cache
+def reset_extracted_frames(job):
+    remove_partial_frames(job)
+    for path in [job.frames_generated_dir, job.frames_missing_dir]:
+        trash_path(path)
+    remove_partial_video(job)
+    create_directories(job)
+
 
-        # Mock as if img2img process was finished - just for test purposes
-        if test_environment:
-            print('Mocking img2img process..')
-            url = "https://huggingface.co/datasets/scuti0/extension-test/resolve/main/frames.zip"
-            download_and_unzip_frames(url, frames_generated_dir)
 
-        rename_files(frames_generated_dir)
-        print('Files renamed..')
+# Cores this process may run on, which can be fewer than the machine has in containers or with taskset
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
 
-        print('Creating video..')
 
-        frames_generated_pattern =  os.path.join(frames_generated_dir,"0%4d.png")
-       
-        output_video_path = os.path.join(output_video_dir,"out.mp4")
 
-        command = f"ffmpeg -r 30 -framerate 5 -start_number 0000 -i \"{frames_generated_pattern}\" -c:v libx264 -vf \"fps={fps},format=yuv420p\" \"{output_video_path}\""
-        print(command)
+# Encoder threads of an encode about to start, one of processes encodes of its job running at once
+# The available cores are shared between these, or between all ffmpeg processes of any job when more hold a slot
+def encoder_threads(processes=1):
+    with ffmpeg_slots_lock:
+        running = ffmpeg_slots_in_use["count"] + 1
+    return max(1, available_cores() // max(processes, running))
+
+
+
+# Encoder profile and target bitrate (kbit/s, used by the two-pass profile) of a video
+def encoder_settings(encoder_profile="Balanced", target_bitrate=4000):
+    if encoder_profile not in encoder_profiles:
+        raise Exception(f"Unknown encoder profile '{encoder_profile}'.")
+    if encoder_profile == two_pass_profile and int(target_bitrate) <= 0:
+        raise Exception("Set a target bitrate for the two-pass profile.")
+    return {"profile": encoder_profile, "bitrate": int(target_bitrate)}
+
+
+
+# ffmpeg output options of each encoding pass, a single pass for CRF profiles
+# The two-pass profile analyses the video first, writing its stats next to passlog_path
+def encoder_passes(encoder, threads, passlog_path):
+    options = ["-c:v", "libx264", "-threads", str(threads)] + encoder_profiles[encoder["profile"]]
+    if encoder["profile"] != two_pass_profile:
+        return [options]
+    options += ["-b:v", f"{encoder['bitrate']}k", "-passlogfile", passlog_path]
+    return [options + ["-pass", "1"], options + ["-pass", "2"]]
+
+
+
+# Encode frames to a video with the encoder profile, muxing audio from audio_mux_options in the last pass
+def run_encode(input_options, video_filter, output_video_path, encoder, threads, job=None, audio=([], [])):
+    require_ffmpeg(["libx264"])
+    audio_inputs, audio_options = audio
+    passlog_path = f"{output_video_path}.passlog"
+    passes = encoder_passes(encoder, threads, passlog_path)
+    try:
+        for index, pass_options in enumerate(passes):
+            if index < len(passes) - 1:
+                # analysis pass, its video is thrown away
+                command = (["ffmpeg", "-y"] + input_options + ["-vf", video_filter] + pass_options
+                           + ["-an", "-f", "null", "-"])
+            else:
+                command = (["ffmpeg", "-y"] + input_options + audio_inputs + ["-vf", video_filter] + pass_options
+                           + audio_options + [output_video_path])
+            return_code = run_ffmpeg(command, job)
+            if return_code != 0:
+                return return_code
+        return 0
+    finally:
+        passlog_dir, passlog_name = os.path.split(passlog_path)
+        for filename in os.listdir(passlog_dir):
+            if filename.startswith(passlog_name):
+                os.remove(os.path.join(passlog_dir, filename))
+
+
+
+# Split a frame sequence in contiguous (start, length) segments, one per worker
+# Segment lengths are multiples of frame_step, so extracted ranges start on a frame kept at the keyframe interval
+def split_segments(frame_count, workers, frame_step=1):
+    segment_length = max(min_segment_frames, math.ceil(frame_count / workers))
+    segment_length = math.ceil(segment_length / frame_step) * frame_step
+    return [(start, min(segment_length, frame_count - start))
+            for start in range(0, frame_count, segment_length)]
+
+
+
+# Write an ffconcat list showing each frame file for frame_duration seconds
+def write_frames_list(list_path, frame_paths, frame_duration):
+    # quotes are escaped as '\'' inside ffconcat quoted paths
+    quoted_paths = ["'" + frame_path.replace("'", "'\\''") + "'" for frame_path in frame_paths]
+    with open(list_path, 'w') as file:
+        file.write("ffconcat version 1.0\n")
+        for quoted_path in quoted_paths:
+            file.write(f"file {quoted_path}\nduration {float(frame_duration):.6f}\n")
+    return list_path
+
+
+
+# Video filter timing the frames of a write_frames_list list exactly, frame_duration apart, the first one being frame start
+# The concat demuxer keeps the time base of the image demuxer (1/25 s), which rounds the listed durations
+def frames_list_timing(frame_duration, start=0):
+    return f"settb={Fraction(frame_duration)},setpts=N+{start},"
+
+
+
+# Encode length frame files of frame_paths from start to a video segment, at rate input frames per second
+# Frames are timed from start and cut on the output timeline, so joined segments hold the frames of a single encode
+# of frame_paths at fps, whatever the segment lengths; the last segment (length None) runs to the end like it
+def encode_segment(frame_paths, rate, fps, segment_path, threads, scale_filter="", job=None, encoder=None, start=0,
+                   length=None):
+    end = len(frame_paths) if length is None else min(start + length, len(frame_paths))
+    if end < len(frame_paths):
+        # the first frame of the next segment tells the fps conversion when the last one of this segment ends
+        frames_filter = (f"fps={fps},tpad=stop_mode=clone:stop=-1,"
+                         f"trim=start_pts={math.ceil(start * fps / rate)}:end_pts={math.ceil(end * fps / rate)},")
+        end += 1
+    else:
+        frames_filter = f"fps={fps},trim=start_pts={math.ceil(start * fps / rate)},"
+    list_path = write_frames_list(f"{segment_path}.txt", frame_paths[start:end], 1 / rate)
+    if run_encode(["-f", "concat", "-safe", "0", "-i", list_path],
+                  f"{frames_list_timing(1 / rate, start)}{frames_filter}setpts=PTS-STARTPTS,{scale_filter}format=yuv420p",
+                  segment_path, encoder or encoder_settings(), threads, job) != 0:
+        raise Exception(f"Could't encode segment {os.path.basename(segment_path)} with ffmpeg.")
+    return segment_path
+
+
+
+# Join encoded segments losslessly with the concat demuxer, muxing audio from audio_mux_options
+def concat_segments(segment_paths, output_video_path, job=None, audio=([], [])):
+    # concat demuxer resolves paths relative to the list file
+    list_path = os.path.join(os.path.dirname(segment_paths[0]), "segments.txt")
+    with open(list_path, 'w') as file:
+        for segment_path in segment_paths:
+            file.write(f"file '{os.path.basename(segment_path)}'\n")
+
+    audio_inputs, audio_options = audio
+    command = (["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", list_path] + audio_inputs
+               + ["-c:v", "copy"] + audio_options + [output_video_path])
+    return run_ffmpeg(command, job)
+
+
+
+# Empty directory for encoded segments of a video
+def reset_segments_dir(output_video_path):
+    segments_dir = os.path.join(os.path.dirname(output_video_path), "segments")
+    trash_path(segments_dir)
+    os.makedirs(segments_dir)
+    return segments_dir
+
+
+
+# Encode frame files in parallel segments, one ffmpeg process each, then join them losslessly
+def encode_segments(frame_paths, rate, fps, output_video_path, workers, scale_filter="", job=None, audio=([], []),
+                    encoder=None):
+    segments_dir = reset_segments_dir(output_video_path)
+
+    segments = split_segments(len(frame_paths), workers)
+    print(f"Encoding {len(frame_paths)} frames in {len(segments)} segments..")
+
+    def encode(index, start, length):
+        segment_path = os.path.join(segments_dir, f"segment{index:03d}.mp4")
+        # threads sized when the segment starts, against the ffmpeg processes of every job running then
+        encode_segment(frame_paths, rate, fps, segment_path, encoder_threads(len(segments)), scale_filter, job, encoder,
+                       start, length)
+        print(f"Segment {index + 1}/{len(segments)} encoded (frames {start}-{start + length - 1})..")
+        return segment_path
+
+    with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+        futures = [executor.submit(encode, index, start, length)
+                   for index, (start, length) in enumerate(segments)]
+        segment_paths = [future.result() for future in futures]
+
+    if job is not None:
+        start_progress(job, "Joining segments", float(len(frame_paths) / rate))
+    return concat_segments(segment_paths, output_video_path, job, audio)
+
+
+
+# Encode each shot of the manifest to its own segment in parallel, then join them losslessly
+# A segment is named after a fingerprint of its generated frames and video settings, so shots left unchanged
+# since the last video are reused and only regenerated shots are encoded again
+# Returns the concat exit code and the number of shots encoded
+def encode_shots(job, manifest, frame_paths, rate, fps, output_video_path, scale_filter="", interpolation="blend",
+                 encoder=None, audio=([], [])):
+    encoder = encoder or encoder_settings()
+    shots_dir = os.path.join(os.path.dirname(output_video_path), "shots")
+    os.makedirs(shots_dir, exist_ok=True)
+    keyframe_interval = manifest.get("keyframe_interval", 1)
+    frame_duration = keyframe_interval / rate
+    settings = [str(rate), str(fps), keyframe_interval, interpolation, scale_filter, encoder,
+                encoder_profiles[encoder["profile"]]]
+
+    shots = []
+    for index, (start, end) in enumerate(manifest["shots"]):
+        shot_paths = frame_paths[start:end]
+        # output frames of the shot on the timeline of a single encode, so joined shots don't drift from the audio
+        output_frames = math.ceil(end * frame_duration * fps) - math.ceil(start * frame_duration * fps)
+        files = [(os.path.basename(path), os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in shot_paths]
+        fingerprint = hashlib.sha256(json.dumps([settings, output_frames, files]).encode()).hexdigest()[:16]
+        shots.append((index, shot_paths, output_frames, os.path.join(shots_dir, f"shot{index + 1:03d}-{fingerprint}.mp4")))
+
+    # segments of older frames and settings, and partial segments of a cancelled encode
+    segment_paths = [segment_path for index, shot_paths, output_frames, segment_path in shots]
+    for filename in os.listdir(shots_dir):
+        if os.path.join(shots_dir, filename) not in segment_paths:
+            os.remove(os.path.join(shots_dir, filename))
+    changed = [shot for shot in shots if not os.path.exists(shot[3])]
+    print(f"{len(shots) - len(changed)} of {len(shots)} shots unchanged, encoding the other {len(changed)}..")
+
+    workers = max(1, min(len(changed), available_cores()))
+    frame_filter = interpolation_filter(keyframe_interval, rate, interpolation)
+    if job is not None:
+        passes = 2 if encoder["profile"] == two_pass_profile else 1
+        start_progress(job, "Encoding changed shots", float(sum(len(shot[1]) for shot in changed) * frame_duration) * passes)
+
+    def encode(index, shot_paths, output_frames, segment_path):
+        # encoded aside, so a cancelled encode never leaves a segment that looks complete
+        partial_path = segment_path[:-len(".mp4")] + ".partial.mp4"
+        list_path = write_frames_list(f"{partial_path}.txt", shot_paths, frame_duration)
+        # the last frame is held or cut so the shot lasts exactly output_frames
+        video_filter = (f"{frames_list_timing(frame_duration)}{frame_filter}fps={fps},"
+                        f"tpad=stop_mode=clone:stop=-1,trim=end_frame={output_frames},"
+                        f"{scale_filter}format=yuv420p")
+        # threads sized when the shot starts, against the ffmpeg processes of every job running then
+        if run_encode(["-f", "concat", "-safe", "0", "-i", list_path], video_filter, partial_path, encoder,
+                      encoder_threads(workers), job) != 0:
+            raise Exception(f"Could't encode shot {index + 1} with ffmpeg.")
+        os.replace(partial_path, segment_path)
+        os.remove(list_path)
+        print(f"Shot {index + 1}/{len(shots)} encoded ({len(shot_paths)} frames)..")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(encode, *shot) for shot in changed]
+        for future in futures:
+            future.result()
+
+    if job is not None:
+        start_progress(job, "Joining shots", float(len(frame_paths) * frame_duration))
+    return concat_segments(segment_paths, output_video_path, job, audio), len(changed)
+
+
+
+# Follow img2img output and encode each completed run of frames into a segment
+# Runs in a background thread started by watch_generated_frames, until all frames are encoded,
+# or until img2img is done (finish event) and no more frames are coming
+def watch_frames_loop(job, fps, output_video_path, scale_filter="", encoder=None):
+    manifest = read_frames_manifest(job)
+    total = len(manifest["frames"])
+    segments_dir = reset_segments_dir(output_video_path)
+    rate = manifest_rate(manifest)
+
+    segment_paths = []
+    start = 0
+    sizes = {}
+    while start < total and not job.watch["stop"].is_set():
+        finishing = job.watch["finish"].is_set()
+        generated = find_generated_frames(job.frames_generated_dir)
+
+        # img2img may still be writing a file, it's complete once its size is unchanged between two polls
+        current_sizes = {filename: os.path.getsize(os.path.join(job.frames_generated_dir, filename))
+                         for filename in generated.values()}
+        complete = {frame: filename for frame, filename in generated.items()
+                    if current_sizes[filename] > 0 and (finishing or sizes.get(filename) == current_sizes[filename])}
+        sizes = current_sizes
+
+        frames = timeline_frames(manifest, complete)
+        if finishing:
+            # no more frames are coming, the remaining gaps repeat their neighbours
+            frames, missing = fill_missing_frames(manifest, frames)
+            job.watch["missing"] = missing
+
+        length = min(min_segment_frames, total - start)
+        # a segment before the last one also needs the first frame of the next, see encode_segment
+        needed = length + 1 if start + length < total else length
+        if None not in frames[start:start + needed]:
+            segment_path = os.path.join(segments_dir, f"segment{len(segment_paths):03d}.mp4")
+            frame_paths = [filename and os.path.join(job.frames_generated_dir, filename) for filename in frames]
+            encode_segment(frame_paths, rate, fps, segment_path, encoder_threads(), scale_filter, job, encoder,
+                           start, length)
+            segment_paths.append(segment_path)
+            print(f"Watch mode: frames {start}-{start + length - 1} of {total} encoded..")
+            start += length
+        else:
+            job.watch["finish"].wait(watch_interval)
+
+    if job.watch["stop"].is_set() or not segment_paths:
+        return None
+    if concat_segments(segment_paths, output_video_path, job, audio_mux_options(job, float(total / rate))) != 0:
+        raise Exception("Could't join segments with ffmpeg.")
+    return output_video_path
+
+
+
+# Background thread target, keeping the result or error for combine_frames
+def run_watch(job, fps, output_video_path, scale_filter="", encoder=None):
+    try:
+        job.watch["output"] = watch_frames_loop(job, fps, output_video_path, scale_filter, encoder)
+    except Exception as error:
+        print("An exception occurred in watch mode:", error)
+        job.watch["error"] = error
+
+
+
+# Start encoding generated frames in the background, while img2img is still running
+def watch_generated_frames(fps, output_size="Generated frames", output_width=0, output_height=0,
+                           encoder_profile="Balanced", target_bitrate=4000, job_id=None):
+    try:
+        job = get_job(job_id)
+        if job.watch["thread"] is not None and job.watch["thread"].is_alive():
+            return "Watch mode is already running.."
+        manifest = read_frames_manifest(job)
+        if manifest.get("keyframe_interval", 1) > 1:
+            return "Watch mode is not available with keyframe interpolation, use 'Create Video' after img2img.."
+        scale_filter = output_scale_filter(manifest, output_size, output_width, output_height)
+        encoder = encoder_settings(encoder_profile, target_bitrate)
+        fps = output_rate(manifest, fps)
+
+        job.cancelled.clear()
+        job.watch["finish"] = threading.Event()
+        job.watch["stop"] = threading.Event()
+        job.watch["output"] = None
+        job.watch["error"] = None
+        job.watch["missing"] = []
+        job.watch["settings"] = (fps, scale_filter, encoder)
+        job.watch["thread"] = threading.Thread(target=run_watch,
+                                               args=(job, fps, os.path.join(job.output_video_dir, "out.mp4"),
+                                                     scale_filter, encoder),
+                                               daemon=True)
+        job.watch["thread"].start()
+        print(f"Watch mode started at {float(fps):.5g} fps..")
+        return "Watch mode started: frames are encoded while img2img generates them. Hit 'Create Video' when img2img finishes.."
+
+    except Exception as error:
+        print("An exception occurred:", error)
+        return f"An exception occurred: {error}"
+
+
+
+# Stop watch mode without finishing its video
+def stop_watch(job):
+    if job.watch["thread"] is not None:
+        job.watch["stop"].set()
+        job.watch["finish"].set()
+        job.watch["thread"].join()
+        job.watch["thread"] = None
+
+
+
+# Tell watch mode img2img is done, and wait for its last segment and concat
+# Returns the video path, or None when watch mode isn't running with these settings
+def finish_watch(job, fps, scale_filter="", encoder=None):
+    thread = job.watch["thread"]
+    if thread is None:
+        return None
+    if job.watch["settings"] != (fps, scale_filter, encoder or encoder_settings()):
+        print('Watch mode settings differ from selected settings, encoding again..')
+        stop_watch(job)
+        return None
+
+    print('Waiting for watch mode to finish..')
+    start_progress(job, "Waiting for watch mode to finish", 0)
+    job.watch["finish"].set()
+    thread.join()
+    job.watch["thread"] = None
+    # cancelled watch mode left no video
+    if job.watch["stop"].is_set():
+        return None
+    if job.watch["error"] is not None:
+        raise job.watch["error"]
+    return job.watch["output"]
+
+
+
+# Append missing generated frames to a message, and print them
+def missing_frames_message(message, missing):
+    if not missing:
+        return message
+    print(f"Generated frames missing, filled with their neighbours: {', '.join(missing)}")
+    shown = ", ".join(missing[:10]) + (".." if len(missing) > 10 else "")
+    return f"{message} {len(missing)} missing frames filled with their neighbours: {shown}"
+
+
+
+# Point img2img batch input to the frames still missing, to resume an interrupted batch
+def resume_frames(job_id=None):
+    try:
+        job = get_job(job_id)
+        stop_watch(job);
+        missing, corrupt = build_missing_frames(job)
+        if not missing:
+            message = "All frames are already generated.."
+            print(message)
+            return [message, gr.update(value=add_slash(job.frames_dir))]
+
+        message = f"{len(missing)} frames left to generate ({corrupt} incomplete frames removed). Send the new input directory to img2img batch.."
+        print(message)
+        return [message, gr.update(value=add_slash(job.frames_missing_dir))]
+
+    except Exception as error:
+        print("An exception occurred:", error)
+        return [f"An exception occurred: {error}", gr.update()]
+
+
+
+# Encode generated frames to the output video, or finish the one watch mode is encoding
+# Returns the result message and the video path
+def create_video(job, manifest, fps, interpolation="blend", scale_filter="", encoder=None):
+    encoder = encoder or encoder_settings()
+    rate = manifest_rate(manifest)
+    fps = output_rate(manifest, fps)
+    # frames already encoded by watch mode, only the last segment and concat were left
+    output_video_path = None
+    if job.watch["thread"] is not None:
+        with measure_stage(job, "finish_watch") as record:
+            output_video_path = finish_watch(job, fps, scale_filter, encoder)
+            if output_video_path is not None:
+                record["frames"] = len(manifest["frames"])
+                record["bytes_written"] = os.path.getsize(output_video_path)
+    if output_video_path is not None:
+        print('Video created successfully by watch mode..')
+        return missing_frames_message("Video created successfully..", job.watch["missing"]), output_video_path
+    check_cancelled(job)
+
+    # matching generated files to the original timeline, rename_files did this before manifests
+    with measure_stage(job, "timeline") as record:
+        frame_files, missing = fill_missing_frames(manifest, generated_timeline(job.frames_generated_dir, manifest))
+        frame_paths = [os.path.join(job.frames_generated_dir, filename) for filename in frame_files]
+        record["frames"] = len(frame_paths)
+        record["missing"] = len(missing)
+
+    print('Creating video..')
+
+    output_video_path = os.path.join(job.output_video_dir,"out.mp4")
+
+    # keyframes are spread over the same duration, then interpolated back to the extraction rate
+    # frames keep the rate they were extracted at, so the video lasts as long as the source and its audio
+    keyframe_interval = manifest.get("keyframe_interval", 1)
+    if keyframe_interval > 1:
+        require_ffmpeg(filters=["minterpolate"])
+    if manifest.get("shots"):
+        require_ffmpeg(filters=["tpad", "trim"])
+    frame_filter = interpolation_filter(keyframe_interval, rate, interpolation)
+    duration = float(len(frame_paths) * keyframe_interval / rate)
+    # progress of both passes of a two-pass encode adds up
+    start_progress(job, "Creating video", duration * (2 if encoder["profile"] == two_pass_profile else 1))
+    audio = audio_mux_options(job, duration)
+
+    message = "Video created successfully.."
+    with measure_stage(job, "encode") as record:
+        # interpolation needs neighbour frames across the whole clip, so it's always encoded in one process
+        # unless frames were split at scene cuts, where each shot is interpolated on its own
+        workers = available_cores()
+        if manifest.get("shots"):
+            return_code, record["shots_encoded"] = encode_shots(job, manifest, frame_paths, rate, fps, output_video_path,
+                                                                scale_filter, interpolation, encoder, audio)
+            record["shots"] = len(manifest["shots"])
+            message = f"{message} {record['shots_encoded']} of {record['shots']} shots encoded, the others were unchanged."
+        elif keyframe_interval == 1 and workers > 1 and len(frame_paths) >= 2 * min_segment_frames:
+            return_code = encode_segments(frame_paths, rate, fps, output_video_path, workers, scale_filter, job, audio,
+                                          encoder)
+        else:
+            list_path = write_frames_list(os.path.join(job.output_video_dir, "frames.txt"),
+                                          frame_paths, keyframe_interval / rate)
+            return_code = run_encode(["-f", "concat", "-safe", "0", "-i", list_path],
+                                     f"{frames_list_timing(keyframe_interval / rate)}{frame_filter}fps={fps},"
+                                     f"{scale_filter}format=yuv420p",
+                                     output_video_path, encoder, encoder_threads(), job, audio)
 
-        return_code = subprocess.call(command, shell=True)
-                        
         # Check the return code to determine if the installation was successful
         if return_code == 0:
             print('Video created successfully..')
         else:
-            raise Exception("Could't create video with ffmpeg.")              
-        
-        return ["Video created successfully..",
-                gr.update(value=output_video_path,visible=True),
-                gr.update(visible=False), gr.update(visible=False)]
+            raise Exception("Could't create video with ffmpeg.")
+        record["frames"] = len(frame_paths)
+        record["bytes_read"] = sum(os.path.getsize(frame_path) for frame_path in set(frame_paths))
+        record["bytes_written"] = os.path.getsize(output_video_path)
+        record["encoder_profile"] = encoder["profile"]
+
+    return missing_frames_message(message, missing), output_video_path
+
+
+
+# Encode a small, fast proxy of generated frames from start_frame to end_frame (0 is the last frame),
+# taking every frame_step-th frame, to check img2img settings before the full encode
+def create_preview(job, manifest, fps, start_frame=1, end_frame=0, frame_step=1):
+    fps = output_rate(manifest, fps)
+    frame_files, missing = fill_missing_frames(manifest, generated_timeline(job.frames_generated_dir, manifest))
+    start_frame = max(1, int(start_frame))
+    end_frame = int(end_frame) if int(end_frame) > 0 else len(frame_files)
+    frame_step = max(1, int(frame_step))
+    frame_paths = [os.path.join(job.frames_generated_dir, filename)
+                   for filename in frame_files[start_frame - 1:end_frame:frame_step]]
+    if not frame_paths:
+        raise Exception(f"No frames between {start_frame} and {end_frame}.")
+
+    require_ffmpeg(["libx264"])
+    print('Creating preview..')
+    output_video_path = os.path.join(job.output_video_dir, "preview.mp4")
+    # skipped frames are shown longer, so the preview keeps the timing of the video
+    frame_duration = frame_step * manifest.get("keyframe_interval", 1) / manifest_rate(manifest)
+    start_progress(job, "Creating preview", float(len(frame_paths) * frame_duration))
+
+    with measure_stage(job, "preview") as record:
+        list_path = write_frames_list(os.path.join(job.output_video_dir, "preview.txt"), frame_paths, frame_duration)
+        command = ["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", list_path,
+                   "-c:v", "libx264", "-preset", "ultrafast", "-crf", "30",
+                   "-vf", f"{frames_list_timing(frame_duration)}scale=-2:'min({preview_height},ih)':flags=fast_bilinear,"
+                          f"fps={fps},format=yuv420p",
+                   output_video_path]
+        if run_ffmpeg(command, job) != 0:
+            raise Exception("Could't create preview with ffmpeg.")
+        record["frames"] = len(frame_paths)
+        record["bytes_written"] = os.path.getsize(output_video_path)
+
+    message = f"Preview of {len(frame_paths)} frames created.. Hit 'Create Video' for the full quality video."
+    return missing_frames_message(message, missing), output_video_path
+
+
+
+# Show a preview of generated frames in the video player, streaming ffmpeg progress to the output message
+def preview_video(fps, start_frame=1, end_frame=0, frame_step=1, job_id=None):
+    job = None
+    try:
+        job = get_job(job_id)
+
+        # Mock as if img2img process was finished - just for test purposes
+        if test_environment:
+            print('Mocking img2img process..')
+            mock_img2img(job)
+
+        manifest = read_frames_manifest(job)
+        message, output_video_path = yield from stream_progress(job,
+                                                                lambda: create_preview(job, manifest, fps, start_frame,
+                                                                                       end_frame, frame_step),
+                                                                lambda progress: [progress, gr.update()])
+        yield [message, gr.update(value=output_video_path, visible=True)]
+
+    except Exception as error:
+        message = f"An exception occurred: {error}"
+        if job is not None and job.cancelled.is_set():
+            message = "Preview cancelled.."
+        print(message)
+        yield [message, gr.update()]
+
+
+
+# Estimate the size and encoding time of the video from a sample encode of a few seconds of generated frames
+# Returns the estimate message
+def estimate_video(job, manifest, fps, interpolation="blend", scale_filter="", encoder=None):
+    encoder = encoder or encoder_settings()
+    rate = manifest_rate(manifest)
+    fps = output_rate(manifest, fps)
+    frame_files, missing = fill_missing_frames(manifest, generated_timeline(job.frames_generated_dir, manifest))
+    keyframe_interval = manifest.get("keyframe_interval", 1)
+    frame_duration = keyframe_interval / rate
+    duration = float(len(frame_files) * frame_duration)
+
+    # a third of the sample from the start, the middle and the end, scenes differ in how well they compress
+    chunk = max(2, round(estimate_sample_seconds / 3 / frame_duration))
+    if len(frame_files) <= 3 * chunk:
+        sample_files = frame_files
+    else:
+        sample_files = []
+        for start in [0, (len(frame_files) - chunk) // 2, len(frame_files) - chunk]:
+            sample_files += frame_files[start:start + chunk]
+
+    print(f"Estimating video size from a sample of {len(sample_files)} frames..")
+    sample_path = os.path.join(job.output_video_dir, "sample.mp4")
+    list_path = write_frames_list(os.path.join(job.output_video_dir, "sample.txt"),
+                                  [os.path.join(job.frames_generated_dir, filename) for filename in sample_files],
+                                  frame_duration)
+    start_time = time.perf_counter()
+    try:
+        return_code = run_encode(["-f", "concat", "-safe", "0", "-i", list_path],
+                                 f"{frames_list_timing(frame_duration)}{interpolation_filter(keyframe_interval, rate, interpolation)}"
+                                 f"fps={fps},{scale_filter}format=yuv420p",
+                                 sample_path, encoder, encoder_threads())
+        if return_code != 0:
+            raise Exception("Could't encode the sample with ffmpeg.")
+        sample_seconds = time.perf_counter() - start_time
+        sample_bytes = os.path.getsize(sample_path)
+    finally:
+        for path in [sample_path, list_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    scale = len(frame_files) / len(sample_files)
+    # a target bitrate is what two-pass encoding lands on, a CRF sample only tells how well this video compresses
+    if encoder["profile"] == two_pass_profile:
+        video_bytes = encoder["bitrate"] * 1000 / 8 * duration
+    else:
+        video_bytes = sample_bytes * scale
+    audio_bytes = os.path.getsize(job.audio_path) if os.path.exists(job.audio_path) else 0
+    total_bytes = video_bytes + audio_bytes
+    message = (f"Estimated video size with '{encoder['profile']}': {total_bytes / 1024 ** 2:.1f} MB "
+               f"({total_bytes * 8 / 1000 / max(duration, 0.001):.0f} kbit/s over {duration:.1f} s), "
+               f"encoding in about {sample_seconds * scale:.0f} s..")
+    print(message)
+    return message
+
+
+
+# Show the size and encoding time estimate of the video with the selected encoder profile
+def estimate_video_size(fps, interpolation="blend", output_size="Generated frames", output_width=0, output_height=0,
+                        encoder_profile="Balanced", target_bitrate=4000, job_id=None):
+    try:
+        job = get_job(job_id)
+
+        # Mock as if img2img process was finished - just for test purposes
+        if test_environment:
+            print('Mocking img2img process..')
+            mock_img2img(job)
+
+        manifest = read_frames_manifest(job)
+        scale_filter = output_scale_filter(manifest, output_size, output_width, output_height)
+        return estimate_video(job, manifest, fps, interpolation, scale_filter,
+                              encoder_settings(encoder_profile, target_bitrate))
 
     except Exception as error:
         print("An exception occurred:", error)
-        return [f"An exception occurred: {error}", gr.update(visible=False),
-                gr.update(visible=True), gr.update(visible=True)]
+        return f"An exception occurred: {error}"
+
+
+
+# Combine frames to video, streaming ffmpeg progress to the output message
+def combine_frames(fps, interpolation="blend", output_size="Generated frames", output_width=0, output_height=0,
+                   encoder_profile="Balanced", target_bitrate=4000, job_id=None):
+    job = None
+    try:
+        job = get_job(job_id)
+        print("Frames per second selected:",fps);
+
+        # Mock as if img2img process was finished - just for test purposes
+        if test_environment:
+            print('Mocking img2img process..')
+            mock_img2img(job)
+
+        manifest = read_frames_manifest(job)
+        scale_filter = output_scale_filter(manifest, output_size, output_width, output_height)
+        encoder = encoder_settings(encoder_profile, target_bitrate)
+
+        message, output_video_path = yield from stream_progress(job,
+                                                                lambda: create_video(job, manifest, fps, interpolation,
+                                                                                     scale_filter, encoder),
+                                                                lambda progress: [progress] + [gr.update()] * 6)
+
+        # with shots, Create Video stays available to re-encode the shots regenerated in img2img afterwards
+        rebuild = bool(manifest.get("shots"))
+        yield [message,
+               gr.update(value=output_video_path,visible=True),
+               gr.update(visible=rebuild), gr.update(visible=rebuild),
+               gr.update(visible=rebuild and manifest.get("keyframe_interval", 1) > 1), gr.update(visible=False),
+               gr.update(visible=rebuild)]
+
+    except Exception as error:
+        message = f"An exception occurred: {error}"
+        if job is not None and job.cancelled.is_set():
+            remove_partial_video(job)
+            message = "Video creation cancelled, partial video removed.."
+        print(message)
+        yield [message, gr.update(visible=False),
+               gr.update(visible=True), gr.update(visible=True),
+               gr.update(), gr.update(), gr.update()]
 
 
 
 # Clear frames after job
-def clear_frames():
+def clear_frames(job_id=None):
     try:
-        remove_directories();
-        create_directories();
+        job = get_job(job_id)
+        # the job folder is moved to the trash, deleted in the background
+        with measure_stage(job, "clear") as record:
+            record["bytes_removed"] = directory_size(job.job_dir)
+            remove_job(job);
         print('Frames cleared successfully..')
         return ["Frames cleared successfully..",
             gr.update(visible=False), gr.update(visible=False),
@@ -222,32 +2288,374 @@ def clear_frames():
             gr.update(visible=False), gr.update(visible=False),
             gr.update(visible=False), gr.update(visible=False),
             gr.update(visible=False), gr.update(visible=False),
-            gr.update(value=None)]
+            gr.update(value=None), gr.update(visible=False),
+            gr.update(visible=False), gr.update(visible=False),
+            None, gr.update(visible=False), gr.update(visible=False),
+            gr.update(visible=False), gr.update(visible=False),
+            gr.update(choices=[], value=None, visible=False)]
     except Exception as error:
         print("An exception occurred:", error)
         return f"An exception occurred: {error}"
 
 
 
+# Files of both frame directories with their names inside the frames archive
+def frames_archive_entries(job):
+    entries = []
+    # zip generated frames, then original frames
+    for directory in [job.frames_generated_dir, job.frames_dir]:
+        for root, dirs, files in os.walk(directory):
+            for file in sorted(files):
+                entries.append((os.path.join(root, file),
+                                os.path.relpath(os.path.join(root, file),
+                                                os.path.join(directory, '..'))))
+    return entries
+
+
+
+# Fingerprint of the archive contents from names, sizes and modification times, without reading any frame
+def frames_archive_fingerprint(entries, compress):
+    digest = hashlib.sha256(f"compress={compress}".encode())
+    for file_path, arcname in entries:
+        stat = os.stat(file_path)
+        digest.update(f"{arcname}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+
+# Write-only file object collecting what ZipFile writes, for streaming an archive while it's built
+# It has no tell/seek, so ZipFile writes entries in its unseekable stream format
+class ZipStreamBuffer:
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+
+# Generate the frames archive in chunks, each frame sent as soon as it's added
+# PNGs don't compress further, so entries are stored unless compress is set
+def stream_frames_archive(job, compress=False):
+    buffer = ZipStreamBuffer()
+    compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    with zipfile.ZipFile(buffer, 'w', compression=compression) as zipf:
+        for file_path, arcname in frames_archive_entries(job):
+            zipf.write(file_path, arcname)
+            yield buffer.pop()
+    yield buffer.pop()
+
+
+
+# Whether A1111 was launched with --api, the extension's REST routes are only registered then
+def api_enabled():
+    if test_environment:
+        return False
+    from modules import shared
+    return bool(shared.cmd_opts.api)
+
+
+
+# Dependencies of the extension's REST routes, asking for the --api-auth credentials like A1111's own API when set
+def api_auth_dependencies():
+    from secrets import compare_digest
+    from fastapi import Depends, HTTPException
+    from fastapi.security import HTTPBasic, HTTPBasicCredentials
+    from modules import shared
+
+    credentials = {}
+    for entry in (shared.cmd_opts.api_auth or "").split(","):
+        if ":" in entry:
+            user, password = entry.strip().split(":", 1)
+            credentials[user] = password
+    if not credentials:
+        return []
+
+    def api_auth(basic: HTTPBasicCredentials = Depends(HTTPBasic())):
+        if basic.username in credentials and compare_digest(basic.password, credentials[basic.username]):
+            return True
+        raise HTTPException(status_code=401, detail="Incorrect username or password", headers={"WWW-Authenticate": "Basic"})
+
+    return [Depends(api_auth)]
+
+
+
+# Serve frames archives as they are built, on A1111 FastAPI app
+# It holds the frames of any job, so like the batch API it's only there with --api, behind --api-auth credentials
+def add_archive_route(demo, app):
+    from fastapi import APIRouter, HTTPException
+    from fastapi.responses import StreamingResponse
+
+    if not api_enabled():
+        print("v2v Helper frames archive streaming not registered, launch A1111 with --api to use it..")
+        return
+    router = APIRouter(dependencies=api_auth_dependencies())
+
+    @router.get("/v2v-helper/jobs/{job_id}/frames.zip")
+    def frames_archive(job_id: str, compress: bool = False):
+        try:
+            job = get_job(job_id)
+        except Exception as error:
+            raise HTTPException(status_code=404, detail=str(error))
+        # not run in an ffmpeg slot, its pace is set by the client download
+        return StreamingResponse(stream_frames_archive(job, compress),
+                                 media_type="application/zip",
+                                 headers={"Content-Disposition": "attachment; filename=frames.zip"})
+
+    app.include_router(router)
+
+
+
+# Serve stage totals to Prometheus at /v2v-helper/metrics, when metrics_endpoint is enabled
+def add_metrics_route(demo, app):
+    if not metrics_endpoint:
+        return
+    from fastapi.responses import PlainTextResponse
+
+    @app.get("/v2v-helper/metrics")
+    def metrics():
+        return PlainTextResponse(metrics_text(), media_type="text/plain; version=0.0.4")
+
+
+
+# Status of a job for the batch API: state of its last extraction or video creation, and where its files are
+def job_status(job):
+    status = {"job_id": job.job_id, "state": "idle", "message": None,
+              "frames_dir": add_slash(job.frames_dir), "frames_generated_dir": add_slash(job.frames_generated_dir),
+              "frames": None, "video": None, "source": None, "shots": read_shot_batches(job)}
+    if os.path.exists(job.frames_manifest_path):
+        status["frames"] = len(read_frames_manifest(job)["frames"])
+    if os.path.exists(job.video_probe_path):
+        with open(job.video_probe_path, 'r') as file:
+            status["source"] = json.load(file)
+
+    task = job.task
+    if task is None:
+        pass
+    elif not task.done():
+        status["state"] = "running"
+        status["message"] = progress_message(job)
+    elif job.cancelled.is_set():
+        status["state"] = "cancelled"
+    elif task.exception() is not None:
+        status["state"] = "failed"
+        status["message"] = str(task.exception())
+    else:
+        status["state"] = "done"
+        status["message"] = task.result()
+
+    if status["state"] != "running" and os.path.exists(os.path.join(job.output_video_dir, "out.mp4")):
+        status["video"] = f"/v2v-helper/api/jobs/{job.job_id}/video"
+    return status
+
+
+
+# Whether the batch API may read a video by its path on this machine, only inside api_video_dirs
+def api_video_allowed(video_path):
+    real_path = os.path.realpath(video_path)
+    for directory in api_video_dirs:
+        try:
+            if os.path.commonpath([real_path, os.path.realpath(directory)]) == os.path.realpath(directory):
+                return True
+        except ValueError:
+            # another drive on Windows
+            continue
+    return False
+
+
+
+# Register REST routes of the batch API on A1111 app, to process videos without the UI
+# submit a video, extract its frames, poll status, combine generated frames and fetch the video
+# Like A1111's own API, the routes are only there with --api, behind --api-auth credentials when set
+def add_batch_api_routes(demo, app):
+    from fastapi import APIRouter, Body, File, Form, HTTPException, UploadFile
+    from fastapi.responses import FileResponse
+    from pydantic import BaseModel
+
+    if not api_enabled():
+        print("v2v Helper batch API not registered, launch A1111 with --api to use it..")
+        return
+    router = APIRouter(dependencies=api_auth_dependencies())
+
+    # same options and defaults as the UI
+    class ExtractOptions(BaseModel):
+        dedup: bool = False
+        dedup_threshold: float = 2
+        keyframe_interval: int = 1
+        extract_workers: int = 1
+        use_cache: bool = True
+        frame_format: str = "PNG"
+        png_level: int = 6
+        frame_quality: int = 90
+        target_width: int = 0
+        target_height: int = 0
+        size_align: int = 8
+        # 0 doesn't split frames at scene cuts
+        scene_threshold: float = 0
+
+    class CombineOptions(BaseModel):
+        # 0 keeps the frame rate of extracted frames
+        fps: float = 0
+        interpolation: str = "blend"
+        output_size: str = "Generated frames"
+        output_width: int = 0
+        output_height: int = 0
+        encoder_profile: str = "Balanced"
+        target_bitrate: int = 4000
+
+    def api_job(job_id, idle=False):
+        try:
+            job = get_job(job_id)
+        except Exception as error:
+            raise HTTPException(status_code=404, detail=str(error))
+        if idle and job.task is not None and not job.task.done():
+            raise HTTPException(status_code=409, detail=f"Job {job_id} is still running.")
+        return job
+
+    # an uploaded file, or the path of a video on this machine inside api_video_dirs
+    @router.post("/v2v-helper/api/jobs")
+    def submit_video(video: UploadFile = File(None), video_path: str = Form(None)):
+        if video is None and not video_path:
+            raise HTTPException(status_code=400, detail="Send a video file or a video_path.")
+        if video is None and not api_video_allowed(video_path):
+            raise HTTPException(status_code=403, detail="video_path is outside the folders allowed by api_video_dirs, upload the video instead.")
+        job = create_job()
+        try:
+            if video is not None:
+                # streamed straight into the job, the upload isn't copied again
+                video_path = os.path.join(job.input_video_dir, "input" + os.path.splitext(video.filename or "")[1].lower())
+                with open(video_path, 'wb') as file:
+                    shutil.copyfileobj(video.file, file)
+                probe_input_video(job, video_path)
+            else:
+                with measure_stage(job, "save_video") as record:
+                    saved_path = save_video(job, video_path)
+                    record["linked"] = os.stat(saved_path).st_nlink > 1
+                    record["bytes_read"] = record["bytes_written"] = 0 if record["linked"] else os.path.getsize(saved_path)
+        except Exception as error:
+            remove_job(job)
+            raise HTTPException(status_code=400, detail=str(error))
+        return job_status(job)
+
+    @router.post("/v2v-helper/api/jobs/{job_id}/extract", status_code=202)
+    def extract(job_id: str, options: ExtractOptions = Body(ExtractOptions())):
+        job = api_job(job_id, idle=True)
+        video_path = input_video_path(job)
+        if video_path is None or not os.path.exists(video_path):
+            raise HTTPException(status_code=400, detail="No video submitted to this job.")
+        # frames, generated frames and videos of a previous extraction don't match the new one
+        reset_extracted_frames(job)
+
+        def work():
+            try:
+                return prepare_frames(job, video_path, **options.dict())
+            except Exception:
+                remove_partial_frames(job)
+                raise
+
+        start_task(job, work)
+        return job_status(job)
+
+    @router.get("/v2v-helper/api/jobs/{job_id}")
+    def status(job_id: str):
+        return job_status(api_job(job_id))
+
+    @router.post("/v2v-helper/api/jobs/{job_id}/combine", status_code=202)
+    def combine(job_id: str, options: CombineOptions = Body(CombineOptions())):
+        job = api_job(job_id, idle=True)
+        manifest = read_frames_manifest(job)
+        scale_filter = output_scale_filter(manifest, options.output_size, options.output_width, options.output_height)
+        try:
+            encoder = encoder_settings(options.encoder_profile, options.target_bitrate)
+        except Exception as error:
+            raise HTTPException(status_code=400, detail=str(error))
+
+        def work():
+            try:
+                return create_video(job, manifest, options.fps, options.interpolation, scale_filter, encoder)[0]
+            except Exception:
+                remove_partial_video(job)
+                raise
+
+        start_task(job, work)
+        return job_status(job)
+
+    @router.post("/v2v-helper/api/jobs/{job_id}/cancel")
+    def cancel(job_id: str):
+        job = api_job(job_id)
+        return {"message": cancel_job(job.job_id)}
+
+    @router.get("/v2v-helper/api/jobs/{job_id}/video")
+    def video(job_id: str):
+        job = api_job(job_id, idle=True)
+        video_path = os.path.join(job.output_video_dir, "out.mp4")
+        if not os.path.exists(video_path):
+            raise HTTPException(status_code=404, detail="No video created for this job yet.")
+        return FileResponse(video_path, media_type="video/mp4", filename="out.mp4")
+
+    @router.delete("/v2v-helper/api/jobs/{job_id}")
+    def delete(job_id: str):
+        job = api_job(job_id)
+        cancel_job(job.job_id)
+        # wait for the cancelled task, so it doesn't write into removed directories
+        if job.task is not None:
+            job.task.exception()
+        remove_job(job)
+        return {"message": f"Job {job_id} removed.."}
+
+    app.include_router(router)
+
+
+
 # Download .zip of generated and original frames
-def download_zip_frames():
-    # Create a zip file
-    zip_filename = os.path.join(output_video_dir,"frames.zip")
-    with zipfile.ZipFile(zip_filename, 'w') as zipf:
-        # zip generated frames
-        for root, dirs, files in os.walk(frames_generated_dir):
-            for file in files:
-                zipf.write(os.path.join(root, file),
-                           os.path.relpath(os.path.join(root, file),
-                                           os.path.join(frames_generated_dir, '..')))
-        # zip original frames
-        for root, dirs, files in os.walk(frames_dir):
-            for file in files:
-                zipf.write(os.path.join(root, file),
-                           os.path.relpath(os.path.join(root, file),
-                                           os.path.join(frames_dir, '..')))
-
-    return [gr.update(value=zip_filename, visible=True), gr.update(visible=False)]
+# The archive is reused while frames don't change, or streamed while it's built
+def download_zip_frames(compress=False, stream=False, job_id=None):
+    job = get_job(job_id)
+
+    if stream:
+        link = f"/v2v-helper/jobs/{job.job_id}/frames.zip?compress={str(bool(compress)).lower()}"
+        print(f"Streaming frames archive from {link}..")
+        return [gr.update(visible=False), gr.update(visible=False),
+                gr.update(value=f'<a href="{link}" download="frames.zip">Download frames.zip</a>', visible=True)]
+
+    zip_filename = os.path.join(job.output_video_dir,"frames.zip")
+    fingerprint_path = f"{zip_filename}.fingerprint"
+    entries = frames_archive_entries(job)
+    fingerprint = frames_archive_fingerprint(entries, compress)
+
+    with measure_stage(job, "zip") as record:
+        record["frames"] = len(entries)
+        record["reused"] = False
+        if os.path.exists(zip_filename) and os.path.exists(fingerprint_path):
+            with open(fingerprint_path, 'r') as file:
+                record["reused"] = file.read() == fingerprint
+
+        if record["reused"]:
+            print('Frames unchanged, reusing frames archive..')
+        else:
+            # Create a zip file, aside so an interrupted archive is never reused
+            temp_filename = f"{zip_filename}.tmp"
+            compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+            with ffmpeg_slot("frames archive"), zipfile.ZipFile(temp_filename, 'w', compression=compression) as zipf:
+                for file_path, arcname in entries:
+                    zipf.write(file_path, arcname)
+            os.replace(temp_filename, zip_filename)
+            with open(fingerprint_path, 'w') as file:
+                file.write(fingerprint)
+            print('Frames archive created..')
+            record["bytes_read"] = sum(os.path.getsize(file_path) for file_path, arcname in entries)
+            record["bytes_written"] = os.path.getsize(zip_filename)
+
+    return [gr.update(value=zip_filename, visible=True), gr.update(visible=False), gr.update(visible=False)]
 
 
 
@@ -280,14 +2688,37 @@ def on_ui_tabs():
     with gr.Blocks(analytics_enabled=False,
                    css=load_custom_css() if test_environment else "") as ui_component:
 
+        # id of this session's job, see create_job
+        job_state = gr.State(None)
+
         # add components
         with gr.Row():
             output_text = gr.Textbox(label="Output message:", interactive=False)
+            cancel_task_button = gr.Button("Cancel extraction / video creation", variant="stop")
 
         with gr.Row():
-            video_input = gr.File(label="Drop your .mp4 video here:", type="file") #change to "filepath" when gradio 4.x
+            video_input = gr.File(label="Drop your video here:", type="file") #change to "filepath" when gradio 4.x
             upload_button = gr.Button("Upload and Extract Frames")
 
+        with gr.Row():
+            dedup = gr.Checkbox(label="Skip near-duplicate frames", value=False)
+            dedup_threshold = gr.Slider(0, 10, value=2, step=0.5, label="Duplicate threshold", show_label=True)
+            keyframe_interval = gr.Slider(1, 8, value=1, step=1, label="Keyframe interval (send every Nth frame to img2img)", show_label=True)
+            extract_workers = gr.Slider(1, 16, value=min(os.cpu_count() or 1, 8), step=1, label="Extraction workers", show_label=True)
+            use_cache = gr.Checkbox(label="Reuse frames if this video was already extracted", value=True)
+
+        with gr.Row():
+            frame_format = gr.Dropdown(["PNG", "JPEG", "WebP", "WebP lossless"], value="PNG", label="Frame format")
+            png_level = gr.Slider(0, 9, value=6, step=1, label="PNG compression level (lower is faster, bigger)", show_label=True)
+            frame_quality = gr.Slider(1, 100, value=90, step=1, label="JPEG/WebP quality", show_label=True)
+            compare_formats_button = gr.Button("Compare frame formats on this video")
+
+        with gr.Row():
+            target_width = gr.Number(value=0, precision=0, label="Frame width, img2img target (0 keeps source size)")
+            target_height = gr.Number(value=0, precision=0, label="Frame height, img2img target (0 keeps source size)")
+            size_align = gr.Radio([8, 64], value=8, label="Round frame size to multiples of")
+            scene_threshold = gr.Slider(0, 1, value=0, step=0.05, label="Split into shots at scene cuts (threshold, 0 is off)", show_label=True)
+
         # add components initially hidden
         with gr.Row():
             label_text = "Please copy these paths to img2img batch input/output directories, or just click 'Send to img2img batch' button:"
@@ -295,31 +2726,55 @@ def on_ui_tabs():
                              label="Message",
                              visible=False,
                              elem_id="sd-webui-v2v-helper-label")
-            textbox1 = gr.Textbox(value=add_slash(frames_dir),
+            textbox1 = gr.Textbox(value="",
                                   label="img2img batch input directory",
                                   lines=4, show_label=True,
                                   interactive=False,
                                   visible=False,
                                   show_copy_button=True)
-            textbox2 = gr.Textbox(value=add_slash(frames_generated_dir),
+            textbox2 = gr.Textbox(value="",
                                   label="img2img batch output directory",
                                   lines=4, show_label=True,
                                   interactive=False,
                                   visible=False,
                                   show_copy_button=True)
+            shot_select = gr.Dropdown([], label="img2img input: all frames or one shot", visible=False)
             send_button = gr.Button("Send to img2img batch", visible=False)
+            resume_button = gr.Button("Resume: send only missing frames", visible=False)
 
         with gr.Row():
-            fps = gr.Slider(8, 30, value=30, step=2, label="Frames per second", show_label=True, visible=False)
+            fps = gr.Slider(0, 60, value=0, step=1, label="Frames per second (0 keeps the source video rate)", show_label=True, visible=False)
+            interpolation = gr.Radio(["blend", "motion"], value="blend", label="Keyframe interpolation", visible=False)
+            with gr.Column(visible=False) as output_options:
+                output_size = gr.Radio(["Generated frames", "Source video", "Custom"], value="Generated frames",
+                                       label="Output video size")
+                output_width = gr.Number(value=0, precision=0, label="Custom width (0 keeps aspect ratio)")
+                output_height = gr.Number(value=0, precision=0, label="Custom height (0 keeps aspect ratio)")
+                encoder_profile = gr.Dropdown(list(encoder_profiles), value="Balanced", label="Encoder profile")
+                target_bitrate = gr.Number(value=4000, precision=0, label="Target bitrate in kbit/s (two-pass profile)")
+                estimate_button = gr.Button("Estimate video size")
+            watch_button = gr.Button("Encode while img2img runs", visible=False)
             create_video_button = gr.Button("Create Video", visible=False)
             video_generated = gr.PlayableVideo(visible=False, format="mp4", elem_id="sd-webui-v2v-helper-video")
 
+        with gr.Row(visible=False) as preview_options:
+            preview_start = gr.Number(value=1, precision=0, label="Preview from frame")
+            preview_end = gr.Number(value=0, precision=0, label="Preview to frame (0 is the last)")
+            preview_step = gr.Slider(1, 10, value=1, step=1, label="Preview every Nth frame", show_label=True)
+            preview_button = gr.Button("Preview (low resolution, fast)")
+
         with gr.Row():
             clear_button = gr.Button("Clear all frames and data", visible=False)
             confirm_btn = gr.Button("Confirm delete? You will lose your previous work!", variant="stop", visible=False)
             cancel_btn = gr.Button("Cancel", visible=False)
             download_zip_btn = gr.Button("Download frames", visible=False)
+            with gr.Column(visible=False) as zip_options:
+                zip_compress = gr.Checkbox(label="Compress archive (slower, PNG frames barely shrink)", value=False)
+                # streaming is served by the frames archive route, only registered with --api
+                zip_stream = gr.Checkbox(label="Start download while the archive is built", value=False,
+                                         visible=api_enabled())
             output_zip = gr.File(label="Download original/generated frames as .zip file", visible=False)
+            zip_link = gr.HTML(visible=False)
 
         # add components just for test purposes, avoiding javascript errors
         if test_environment:
@@ -394,41 +2849,82 @@ def on_ui_tabs():
             """)
 
         upload_button.click(fn=extract_frames,
-                            inputs=video_input,
+                            inputs=[video_input, dedup, dedup_threshold, keyframe_interval, extract_workers, use_cache,
+                                    frame_format, png_level, frame_quality,
+                                    target_width, target_height, size_align, scene_threshold, job_state],
                             outputs=[output_text, label,
                                      textbox1, textbox2,
                                      send_button, fps,
-                                     create_video_button, clear_button])
+                                     create_video_button, clear_button,
+                                     interpolation, watch_button, resume_button,
+                                     output_options, preview_options, shot_select, job_state])
+
+        shot_select.select(fn=select_shot,
+                           inputs=[shot_select, job_state],
+                           outputs=[output_text, textbox1])
+
+        cancel_task_button.click(fn=cancel_job,
+                                 inputs=[job_state],
+                                 outputs=[output_text])
+
+        compare_formats_button.click(fn=compare_frame_formats,
+                                     inputs=[video_input],
+                                     outputs=[output_text])
+
+        preview_button.click(fn=preview_video,
+                             inputs=[fps, preview_start, preview_end, preview_step, job_state],
+                             outputs=[output_text, video_generated])
 
         create_video_button.click(fn=combine_frames,
-                                  inputs=[fps],
+                                  inputs=[fps, interpolation, output_size, output_width, output_height,
+                                          encoder_profile, target_bitrate, job_state],
                                   outputs=[output_text,video_generated,
-                                           fps,create_video_button]);
+                                           fps,create_video_button,
+                                           interpolation, watch_button, output_options]);
+
+        watch_button.click(fn=watch_generated_frames,
+                           inputs=[fps, output_size, output_width, output_height, encoder_profile, target_bitrate,
+                                   job_state],
+                           outputs=[output_text])
+
+        estimate_button.click(fn=estimate_video_size,
+                              inputs=[fps, interpolation, output_size, output_width, output_height,
+                                      encoder_profile, target_bitrate, job_state],
+                              outputs=[output_text])
+
+        resume_button.click(fn=resume_frames,
+                            inputs=[job_state],
+                            outputs=[output_text, textbox1])
 
         clear_button.click(lambda :[gr.update(visible=False),
+                                    gr.update(visible=True),
                                     gr.update(visible=True),
                                     gr.update(visible=True),
                                     gr.update(visible=True)],
-                                    None, [clear_button, confirm_btn, cancel_btn, download_zip_btn])
+                                    None, [clear_button, confirm_btn, cancel_btn, download_zip_btn, zip_options])
 
         cancel_btn.click(lambda :[gr.update(visible=True),
+                                  gr.update(visible=False),
+                                  gr.update(visible=False),
                                   gr.update(visible=False),
                                   gr.update(visible=False),
                                   gr.update(visible=False),
                                   gr.update(visible=False)],
-                                  None, [clear_button, confirm_btn, cancel_btn, download_zip_btn, output_zip])
+                                  None, [clear_button, confirm_btn, cancel_btn, download_zip_btn, output_zip,
+                                         zip_options, zip_link])
 
         download_zip_btn.click(fn=download_zip_frames,
-                               inputs=[],
-                               outputs=[output_zip,download_zip_btn])
+                               inputs=[zip_compress, zip_stream, job_state],
+                               outputs=[output_zip,download_zip_btn,zip_link])
 
         confirm_btn.click(fn=clear_frames,
-                          inputs=[],
+                          inputs=[job_state],
                           outputs=[output_text, label, textbox1,
                                    textbox2, send_button, fps, create_video_button,
                                    video_generated, clear_button, confirm_btn,
                                    cancel_btn, download_zip_btn, output_zip,
-                                   video_input])
+                                   video_input, interpolation, watch_button, resume_button,
+                                   job_state, zip_options, zip_link, output_options, preview_options, shot_select])
 
         return [(ui_component, "v2v Helper", "v2v_helper_tab")]
 
@@ -436,7 +2932,14 @@ if test_environment:
     # Get the UI component
     demo = on_ui_tabs()[0][0]
     # Launch the UI
+    start_housekeeper()
+    # progress of extraction and video creation is streamed through the queue
+    demo.queue()
     demo.launch(share=True,debug=True)
 else:
     # call extension gradio ui in Automatic1111
     script_callbacks.on_ui_tabs(on_ui_tabs)
+    script_callbacks.on_app_started(add_archive_route)
+    script_callbacks.on_app_started(add_batch_api_routes)
+    script_callbacks.on_app_started(add_metrics_route)
+    script_callbacks.on_app_started(start_housekeeper)
@@ -0,0 +1,23 @@
+import os
+import sys
+import types
+import importlib.util
+
+import pytest
+
+
+extension_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+
+# Load the extension script with callbacks that register nothing and no test UI launched
+# It is loaded outside A1111 like benchmark.py does, it needs the A1111 python environment
+@pytest.fixture(scope="session")
+def extension():
+    pytest.importorskip("gradio")
+    script_callbacks = types.SimpleNamespace(on_ui_tabs=lambda callback: None, on_app_started=lambda callback: None)
+    sys.modules["modules"] = types.SimpleNamespace(script_callbacks=script_callbacks)
+    spec = importlib.util.spec_from_file_location("v2v_helper", os.path.join(extension_dir, "scripts", "v2v-helper.py"))
+    extension = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(extension)
+    return extension
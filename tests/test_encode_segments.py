@@ -0,0 +1,65 @@
+import os
+import shutil
+import subprocess
+from fractions import Fraction
+
+import pytest
+
+
+# Segments encoded in parallel must hold the frames of a single encode, whatever the ratio of the frame rates
+# Frames are written as images instead of a video, so they can be compared exactly
+
+
+
+# Frame files each different (testsrc draws the time with 2 decimals)
+@pytest.fixture(scope="module")
+def frame_paths(tmp_path_factory):
+    if shutil.which("ffmpeg") is None:
+        pytest.skip("ffmpeg not found")
+    frames_dir = tmp_path_factory.mktemp("frames")
+    subprocess.run(["ffmpeg", "-v", "error", "-f", "lavfi", "-i", "testsrc=size=64x48:rate=25:decimals=2",
+                    "-frames:v", "400", str(frames_dir / "frame%4d.png")], check=True)
+    return sorted(str(path) for path in frames_dir.iterdir())
+
+
+
+# run_encode writing the frames of the filtered video as images into a folder named after the video
+def run_encode_to_images(input_options, video_filter, output_video_path, encoder, threads, job=None, audio=([], [])):
+    os.makedirs(f"{output_video_path}.frames")
+    return subprocess.run(["ffmpeg", "-v", "error"] + input_options + ["-vf", video_filter, "-fps_mode", "passthrough",
+                           os.path.join(f"{output_video_path}.frames", "frame%5d.png")]).returncode
+
+
+
+def image_frames(video_paths):
+    frames = []
+    for video_path in video_paths:
+        directory = f"{video_path}.frames"
+        frames += [open(os.path.join(directory, filename), 'rb').read() for filename in sorted(os.listdir(directory))]
+    return frames
+
+
+
+def test_segment_lengths_dont_depend_on_frame_rates(extension):
+    # NTSC sources encoded at 30 or 24 fps used to need segments of 1000 or 1250 frames
+    assert len(extension.split_segments(3000, 16)) == 3000 // extension.min_segment_frames
+
+
+
+@pytest.mark.parametrize("rate, fps", [
+    (Fraction(30000, 1001), Fraction(30)),
+    (Fraction(30000, 1001), Fraction(24)),
+    (Fraction(30), Fraction(30000, 1001)),
+    (Fraction(25), Fraction(60)),
+])
+def test_segments_hold_the_frames_of_a_single_encode(extension, frame_paths, tmp_path, monkeypatch, rate, fps):
+    monkeypatch.setattr(extension, "run_encode", run_encode_to_images)
+    segment_paths = []
+    monkeypatch.setattr(extension, "concat_segments", lambda paths, *args, **kwargs: segment_paths.extend(paths) or 0)
+    monkeypatch.setattr(extension, "min_segment_frames", 60)
+
+    extension.encode_segment(frame_paths, rate, fps, str(tmp_path / "single.mp4"), 1)
+    assert extension.encode_segments(frame_paths, rate, fps, str(tmp_path / "out.mp4"), 5) == 0
+
+    assert len(segment_paths) == 5
+    assert image_frames(segment_paths) == image_frames([str(tmp_path / "single.mp4")])
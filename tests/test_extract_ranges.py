@@ -0,0 +1,47 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+
+# Parallel extraction must write the frames of a sequential extraction, frame for frame
+# At 30 fps the range starting at frame 302 starts at 10.0667 s, a time that isn't a whole millisecond
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg not found")
+
+
+
+# A small clip of frames at source_fps, each frame different (testsrc draws a counter)
+def make_clip(path, source_fps, frames):
+    subprocess.run(["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", f"testsrc=size=64x48:rate={source_fps}",
+                    "-frames:v", str(frames), "-c:v", "mpeg4", "-q:v", "2", "-g", "50", path], check=True)
+
+
+
+def frame_files(directory):
+    return [open(os.path.join(directory, filename), 'rb').read() for filename in sorted(os.listdir(directory))]
+
+
+
+@pytest.mark.parametrize("source_fps, source_frames, keyframe_interval", [
+    (30, 402, 1),
+    # 60 fps is extracted at 30, every other frame dropped
+    (60, 804, 1),
+    (30, 402, 2),
+])
+def test_parallel_extraction_matches_sequential(extension, tmp_path, source_fps, source_frames, keyframe_interval):
+    video_path = str(tmp_path / "clip.mp4")
+    make_clip(video_path, source_fps, source_frames)
+    rate = extension.extract_rate({"fps": str(source_fps)})
+    os.makedirs(tmp_path / "sequential")
+    os.makedirs(tmp_path / "parallel")
+
+    subprocess.run(["ffmpeg", "-v", "error", "-i", video_path] + extension.extract_filter(keyframe_interval, rate=rate)
+                   + [str(tmp_path / "sequential" / "frame%4d.png")], check=True)
+    ranges = [(0, 302), (302, 100)]
+    assert extension.extract_ranges(video_path, str(tmp_path / "parallel" / "frame%4d.png"), ranges,
+                                    keyframe_interval, rate=rate) == 0
+
+    sequential = frame_files(tmp_path / "sequential")
+    assert len(sequential) == 402 // keyframe_interval
+    assert frame_files(tmp_path / "parallel") == sequential
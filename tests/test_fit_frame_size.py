@@ -0,0 +1,45 @@
+from fractions import Fraction
+
+import pytest
+
+
+# Frames are scaled to multiples of the alignment without distorting the picture, and never past the target
+
+
+
+@pytest.mark.parametrize("source, target, align, frame_size, crop", [
+    # 16:9 can't be kept exactly in multiples of 64, a few columns of each side are cropped instead of squashing
+    ((1920, 1080), (768, 768), 64, [768, 448], [1851, 1080, 34, 0]),
+    ((1920, 1080), (768, 0), 8, [768, 432], None),
+    ((1080, 1920), (512, 512), 64, [256, 512], [960, 1920, 60, 0]),
+    ((1000, 1000), (500, 500), 64, [448, 448], None),
+    ((1920, 1080), (1920, 1080), 8, None, None),
+])
+def test_fit_frame_size(extension, source, target, align, frame_size, crop):
+    assert extension.fit_frame_size(*source, *target, align) == frame_size
+    assert extension.source_crop(*source, frame_size) == crop
+
+
+
+@pytest.mark.parametrize("align", [8, 64])
+@pytest.mark.parametrize("source", [(1920, 1080), (1280, 720), (720, 1280), (640, 480), (1440, 1080), (854, 480)])
+@pytest.mark.parametrize("target", [(512, 512), (768, 768), (768, 0), (0, 512), (1024, 576)])
+def test_fitted_frames_keep_aspect_ratio_inside_target(extension, source, target, align):
+    frame_size = extension.fit_frame_size(*source, *target, align)
+    if frame_size is None:
+        return
+    for side, target_side, source_side in zip(frame_size, target, source):
+        assert side % align == 0
+        assert side <= (target_side or source_side)
+    crop_width, crop_height, x, y = extension.source_crop(*source, frame_size) or [*source, 0, 0]
+    # the region scaled into the frame has its aspect ratio, to a pixel of the source
+    assert abs(crop_width - crop_height * Fraction(*frame_size)) <= 1
+    assert 0 <= x <= source[0] - crop_width and 0 <= y <= source[1] - crop_height
+
+
+
+def test_source_video_output_scales_to_cropped_region(extension):
+    manifest = {"source_size": [1920, 1080], "frame_size": [768, 448], "source_crop": [1851, 1080, 34, 0]}
+    assert extension.output_scale_filter(manifest, "Source video") == "scale=1850:1080:flags=lanczos,"
+    del manifest["source_crop"]
+    assert extension.output_scale_filter(manifest, "Source video") == "scale=1920:1080:flags=lanczos,"
@@ -0,0 +1,50 @@
+import os
+import json
+
+import pytest
+
+
+# Frames are ordered by their number, past frame9999 ffmpeg writes a fifth digit that breaks string order
+frame_names = ["frame0001.png", "frame0002.png", "frame1000.png", "frame1001.png", "frame9999.png",
+               "frame10000.png", "frame10001.png"]
+
+
+
+# A job with empty files named after frame_names in its frames directory
+@pytest.fixture
+def job(extension, tmp_path, monkeypatch):
+    monkeypatch.setattr(extension, "jobs_dir", str(tmp_path / "jobs"))
+    monkeypatch.setattr(extension, "frames_cache_dir", str(tmp_path / "frames_cache"))
+    job = extension.Job("0123456789ab")
+    extension.create_directories(job)
+    for filename in reversed(frame_names):
+        open(os.path.join(job.frames_dir, filename), 'wb').close()
+    return job
+
+
+
+def test_frame_number_order(extension):
+    assert sorted(reversed(frame_names), key=extension.frame_number) == frame_names
+    # the string order this replaces
+    assert sorted(frame_names) != frame_names
+
+
+
+def test_manifest_without_file_is_in_frame_order(extension, job):
+    assert extension.read_frames_manifest(job)["frames"] == frame_names
+
+
+
+def test_manifest_written_in_string_order_is_read_in_frame_order(extension, job):
+    with open(job.frames_manifest_path, 'w') as file:
+        json.dump({"frames": sorted(frame_names), "duplicates": {}}, file)
+    assert extension.read_frames_manifest(job)["frames"] == frame_names
+
+
+
+def test_timeline_follows_frame_order(extension, job):
+    for filename in frame_names:
+        open(os.path.join(job.frames_generated_dir, f"00{frame_names.index(filename):03d}-{filename}"), 'wb').close()
+    manifest = extension.read_frames_manifest(job)
+    timeline = extension.generated_timeline(job.frames_generated_dir, manifest)
+    assert [filename.split("-", 1)[1] for filename in timeline] == frame_names
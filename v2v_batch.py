@@ -0,0 +1,213 @@
+import os
+import sys
+import json
+import time
+import uuid
+import base64
+import argparse
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Command line client of v2v Helper batch API, running a directory of videos through
+# frame extraction, A1111 img2img and video creation without the UI
+# A1111 must be running on this machine with the extension installed and --api enabled, e.g.:
+#   python v2v_batch.py videos/ --img2img payload.json --concurrency 4
+# payload.json holds the /sdapi/v1/img2img options (prompt, denoising_strength, steps..), init_images is filled per frame
+
+# Seconds between status polls of a running job
+poll_interval = 2
+# Files of the videos directory sent to the extension, which takes any container ffmpeg reads
+video_extensions = (".mp4", ".mov", ".mkv", ".webm", ".avi", ".m4v", ".mpg", ".mpeg", ".ts", ".wmv", ".flv")
+print_lock = threading.Lock()
+
+
+
+# Print a line prefixed with the video it's about, without interleaving threads
+def log(name, message):
+    with print_lock:
+        print(f"[{name}] {message}", flush=True)
+
+
+
+# Authorization header when A1111 runs with --api-auth
+def auth_headers(args):
+    if not args.auth:
+        return {}
+    return {"Authorization": "Basic " + base64.b64encode(args.auth.encode()).decode()}
+
+
+
+# Multipart body uploading a file as the form field, streamed from disk, and its length
+def multipart_body(field, file_path, boundary):
+    filename = os.path.basename(file_path).replace('"', "_")
+    head = (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n").encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+
+    def chunks():
+        yield head
+        with open(file_path, 'rb') as file:
+            while chunk := file.read(1024 * 1024):
+                yield chunk
+        yield tail
+
+    return chunks(), len(head) + os.path.getsize(file_path) + len(tail)
+
+
+
+# Send a request to A1111, returning the decoded JSON response
+# upload is a (form field, file path) pair sent as a multipart form
+def request(args, method, path, data=None, form=None, upload=None):
+    headers = auth_headers(args)
+    body = None
+    if upload is not None:
+        boundary = uuid.uuid4().hex
+        body, length = multipart_body(upload[0], upload[1], boundary)
+        headers["Content-Type"] = f"multipart/form-data; boundary={boundary}"
+        headers["Content-Length"] = str(length)
+    elif form is not None:
+        body = urllib.parse.urlencode(form).encode()
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+    elif data is not None:
+        body = json.dumps(data).encode()
+        headers["Content-Type"] = "application/json"
+
+    http_request = urllib.request.Request(args.server.rstrip("/") + path, data=body, headers=headers, method=method)
+    try:
+        with urllib.request.urlopen(http_request) as response:
+            return json.loads(response.read() or b"null")
+    except urllib.error.HTTPError as error:
+        detail = error.read().decode(errors="replace")
+        raise Exception(f"{method} {path} failed with {error.code}: {detail}")
+
+
+
+# Poll a job until its extraction or video creation is over, printing its progress
+def wait_job(args, name, job_id):
+    last_message = None
+    while True:
+        status = request(args, "GET", f"/v2v-helper/api/jobs/{job_id}")
+        if status["state"] != "running":
+            if status["state"] != "done":
+                raise Exception(f"Job {job_id} {status['state']}: {status['message']}")
+            return status
+        if status["message"] != last_message:
+            log(name, status["message"])
+            last_message = status["message"]
+        time.sleep(poll_interval)
+
+
+
+# Run every extracted frame through A1111 img2img, writing results to the generated frames directory
+def generate_frames(args, name, status, payload):
+    frames_dir = status["frames_dir"]
+    frames_generated_dir = status["frames_generated_dir"]
+    frames = sorted(os.listdir(frames_dir))
+    for index, filename in enumerate(frames):
+        generated_path = os.path.join(frames_generated_dir, os.path.splitext(filename)[0] + ".png")
+        # frames already generated by an interrupted run are kept
+        if os.path.exists(generated_path):
+            continue
+        with open(os.path.join(frames_dir, filename), 'rb') as file:
+            init_image = base64.b64encode(file.read()).decode()
+        result = request(args, "POST", "/sdapi/v1/img2img", data=dict(payload, init_images=[init_image]))
+        with open(generated_path, 'wb') as file:
+            file.write(base64.b64decode(result["images"][0].split(",", 1)[-1]))
+        if (index + 1) % 50 == 0 or index + 1 == len(frames):
+            log(name, f"img2img: {index + 1}/{len(frames)} frames generated..")
+
+
+
+# Submit one video, extract, generate and combine its frames, and download the video
+def process_video(args, video_path, payload):
+    name = os.path.basename(video_path)
+    output_path = os.path.join(args.output, os.path.splitext(name)[0] + ".mp4")
+    if args.video_path:
+        job_id = request(args, "POST", "/v2v-helper/api/jobs", form={"video_path": os.path.abspath(video_path)})["job_id"]
+    else:
+        job_id = request(args, "POST", "/v2v-helper/api/jobs", upload=("video", video_path))["job_id"]
+    log(name, f"Job {job_id} submitted..")
+    try:
+        request(args, "POST", f"/v2v-helper/api/jobs/{job_id}/extract",
+                data={"dedup": args.dedup, "keyframe_interval": args.keyframe_interval,
+                      "extract_workers": args.extract_workers, "frame_format": args.frame_format,
+                      "target_width": args.width, "target_height": args.height,
+                      "scene_threshold": args.scene_threshold})
+        status = wait_job(args, name, job_id)
+        log(name, status["message"])
+
+        generate_frames(args, name, status, payload)
+
+        request(args, "POST", f"/v2v-helper/api/jobs/{job_id}/combine",
+                data={"fps": args.fps, "interpolation": args.interpolation, "output_size": args.output_size,
+                      "encoder_profile": args.encoder_profile, "target_bitrate": args.target_bitrate})
+        status = wait_job(args, name, job_id)
+
+        http_request = urllib.request.Request(args.server.rstrip("/") + status["video"], headers=auth_headers(args))
+        with urllib.request.urlopen(http_request) as response, open(output_path, 'wb') as file:
+            while chunk := response.read(1024 * 1024):
+                file.write(chunk)
+        log(name, f"{status['message']} Saved to {output_path}")
+    finally:
+        if not args.keep:
+            request(args, "DELETE", f"/v2v-helper/api/jobs/{job_id}")
+
+
+
+# Process every video of a directory, a few at once
+def main():
+    parser = argparse.ArgumentParser(description="Run a directory of videos through v2v Helper and A1111 img2img.")
+    parser.add_argument("videos", help="directory of videos (.mp4, .mov, .mkv, .webm..)")
+    parser.add_argument("--img2img", required=True, help="JSON file with /sdapi/v1/img2img options")
+    parser.add_argument("--output", help="directory of created videos (default: <videos>/v2v_output)")
+    parser.add_argument("--server", default="http://127.0.0.1:7860", help="A1111 address")
+    parser.add_argument("--auth", help="user:password when A1111 runs with --api-auth")
+    parser.add_argument("--video-path", action="store_true",
+                        help="send video paths instead of uploading, for videos inside the extension's api_video_dirs")
+    parser.add_argument("--concurrency", type=int, default=2, help="videos processed at once")
+    parser.add_argument("--keep", action="store_true", help="keep jobs and their frames on the server")
+    parser.add_argument("--dedup", action="store_true", help="skip near-duplicate frames")
+    parser.add_argument("--keyframe-interval", type=int, default=1, help="send every Nth frame to img2img")
+    parser.add_argument("--extract-workers", type=int, default=1, help="ffmpeg processes extracting each video")
+    parser.add_argument("--frame-format", default="PNG", choices=["PNG", "JPEG", "WebP", "WebP lossless"])
+    parser.add_argument("--width", type=int, default=0, help="img2img width, frames are downscaled to fit")
+    parser.add_argument("--height", type=int, default=0, help="img2img height, frames are downscaled to fit")
+    parser.add_argument("--scene-threshold", type=float, default=0, help="split frames into shots at scene cuts, 0 is off")
+    parser.add_argument("--fps", type=float, default=0, help="frames per second of created videos, 0 keeps the source rate")
+    parser.add_argument("--interpolation", default="blend", choices=["blend", "motion"])
+    parser.add_argument("--output-size", default="Generated frames", choices=["Generated frames", "Source video"])
+    parser.add_argument("--encoder-profile", default="Balanced",
+                        choices=["Draft (fastest)", "Balanced", "Archival (best quality)", "Target bitrate (two-pass)"])
+    parser.add_argument("--target-bitrate", type=int, default=4000, help="kbit/s of the two-pass encoder profile")
+    args = parser.parse_args()
+
+    with open(args.img2img, 'r') as file:
+        payload = json.load(file)
+    args.output = args.output or os.path.join(args.videos, "v2v_output")
+    os.makedirs(args.output, exist_ok=True)
+
+    videos = sorted(os.path.join(args.videos, filename) for filename in os.listdir(args.videos)
+                    if filename.lower().endswith(video_extensions))
+    print(f"Processing {len(videos)} videos, {args.concurrency} at once..")
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor:
+        futures = {executor.submit(process_video, args, video_path, payload): video_path for video_path in videos}
+        for future, video_path in futures.items():
+            try:
+                future.result()
+            except Exception as error:
+                failed += 1
+                log(os.path.basename(video_path), f"An exception occurred: {error}")
+
+    print(f"{len(videos) - failed} videos created, {failed} failed..")
+    sys.exit(1 if failed else 0)
+
+
+
+if __name__ == "__main__":
+    main()